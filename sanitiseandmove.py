@@ -16,17 +16,53 @@ Contact: joshsmith2@gmail.com
 #TODO: Change the_root to hidden?
 
 import atexit
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import multiprocessing
+import multiprocessing.pool
 import os
 import os.path
+import select
 import shutil
+import signal
+import stat
 import sys
+import threading
+import time
 import swisspy
 import subprocess as sp
 import argparse
 import re
+from ast import literal_eval
+from collections import OrderedDict
 from string import whitespace
 from time import ctime
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Not Unix
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir # Backport for Python 2
+    except ImportError:
+        scandir = None
+
 
 class File:
     """Used to define a file which exists in source and dest
@@ -37,24 +73,39 @@ class File:
         Size of file
     modtime : str
         Last modified time of file
-    md5 : str
-        md5 hash of file
+    hash : str
+        Hash of file's contents
+    hash_algorithm : str
+        The algorithm hash was made with, e.g 'md5'
 
     """
     def __init__(self,
                  path,
                  size="",
                  m_time="",
-                 md5=""):
+                 hash="",
+                 hash_algorithm="md5"):
         self.path = path
         self.size = size
         self.m_time_secs = m_time
-        self.md5 = md5
+        self.hash = hash
+        self.hash_algorithm = hash_algorithm
 
         self.modification_time = None
         if self.m_time_secs:
             self.modification_time = ctime(m_time)
 
+    def report(self):
+        """Return a description of the file for the logs"""
+        file_report = "\n\t{0}:".format(self.path)
+        for attr_name, attr_value in [('size', self.size),
+                                      ('modification_time',
+                                       self.modification_time),
+                                      (self.hash_algorithm, self.hash)]:
+            if attr_value:
+                file_report += "\n\t{0}: {1}".format(attr_name, attr_value)
+        return file_report
+
 def log_list(human_header,  the_list,
              syslog_header="", log_files=[], syslog_files=[],
              log_split='\n\t', syslog_split='\n'):
@@ -111,7 +162,107 @@ def path_join(path1, path2):
     """
     return os.path.abspath(swisspy.unescape(swisspy.prepend(path1, path2)))
 
-def sanitise(in_string, strip_trailing_spaces=True):
+def _compile_sanitiser(black_list, replace_list, strip_from_end):
+    """Build the tables used by sanitise() once, at import time.
+
+    Returns a tuple of (substitutions, illegal_re, strip_from_end), where
+    substitutions maps each offending character to its replacement ('' for
+    deletions) and illegal_re matches any single offending character.
+
+    """
+    substitutions = {}
+    #Substitute any non-space whitespace with spaces
+    for char in whitespace:
+        if char != " ":
+            substitutions[char] = ' '
+    #Remove characters from the blacklist
+    for char in black_list:
+        substitutions[char] = ''
+    #Make any replacements (e.g ':' for '-')
+    for replace_in, replace_out in replace_list:
+        substitutions[replace_in] = replace_out
+    illegal_re = re.compile('[' + re.escape(''.join(substitutions)) + ']')
+    return substitutions, illegal_re, tuple(strip_from_end)
+
+SANITISE_SUBSTITUTIONS, SANITISE_ILLEGAL_RE, SANITISE_STRIP_FROM_END = \
+    _compile_sanitiser(
+        black_list='', #Delete these characters. Currently empty.
+        replace_list=[(':','-'), ('`','_'), ('\\','_'), ('/','_'), ('?','_'),
+                      ('"','_'), ('<','_'), ('>','-'), ('|','_'), ('*','_'),
+                      ('$','_')],
+        strip_from_end=[' '], # Strip any of these characters from the end
+    )
+
+def _sanitise_details(in_string, strip_count):
+    """Work out the 'subs_made' and 'positions' of a sanitise() result.
+
+    in_string : str
+        The string which was sanitised
+    strip_count : int
+        How many characters were stripped from the end of in_string
+
+    """
+    subs = SANITISE_SUBSTITUTIONS
+    subs_made = set() #Any characters which have been substituted. Here to catch ':'
+    positions = []
+    for m in SANITISE_ILLEGAL_RE.finditer(in_string):
+        char = m.group()
+        if subs[char] == ' ':
+            subs_made.add("Whitespace(" + repr(char) + ")")
+        else:
+            subs_made.add(char)
+        positions.append(m.start())
+    if strip_count > 0:
+        for scf in in_string[-strip_count:]:
+            subs_made.add(scf)
+        for r in range(strip_count):
+            positions.append(len(in_string) - r - 1)
+    return subs_made, positions
+
+class SanitiseResult(dict):
+    """The dictionary returned by sanitise().
+
+    If created lazily, 'subs_made' and 'positions' are only worked out the
+    first time either is looked up - e.g when a dry run report line is
+    written - so that renaming large trees never pays for them. Note that
+    until then they won't show up in 'in', get() or keys().
+
+    in_string : str
+        The string which was sanitised
+    strip_count : int
+        How many characters were stripped from the end of in_string
+
+    """
+    def __init__(self, in_string, out_string, strip_count, lazy=False):
+        dict.__init__(self, out_string=out_string)
+        self.in_string = in_string
+        self.strip_count = strip_count
+        if not lazy:
+            self._fill_details()
+
+    def _fill_details(self):
+        subs_made, positions = _sanitise_details(self.in_string,
+                                                 self.strip_count)
+        self['subs_made'] = subs_made
+        self['positions'] = positions
+
+    def __missing__(self, key):
+        if key not in ('subs_made', 'positions'):
+            raise KeyError(key)
+        self._fill_details()
+        return self[key]
+
+    def copy(self):
+        """Return a copy which can be safely modified, staying lazy if this
+        result's details haven't been worked out yet."""
+        other = SanitiseResult(self.in_string, self['out_string'],
+                               self.strip_count, lazy=True)
+        if 'subs_made' in self:
+            other['subs_made'] = set(self['subs_made'])
+            other['positions'] = list(self['positions'])
+        return other
+
+def sanitise(in_string, strip_trailing_spaces=True, lazy=False):
     """Remove any occurrences of characters found in black_list from theString,
     except ':' which, for legibility, are changed to '-'
 
@@ -121,61 +272,1912 @@ def sanitise(in_string, strip_trailing_spaces=True):
     in_string : str
         The string to be processed
     strip_trailing_spaces : Bool
-        If true, remove any number of trailing spaces from the end of the string.
+        Unused: trailing spaces are always removed from the end of the
+        string, as they always have been. Kept for existing callers.
+    lazy : Bool
+        If true, only work out the characters substituted and their positions
+        when they are first looked up. See SanitiseResult.
     """
-    black_list = '' #Delete these characters. Currently empty.
-    replace_list = [(':','-'), ('`','_'), ('\\','_'), ('/','_'), ('?','_'),
-                   ('"','_'), ('<','_'), ('>','-'), ('|','_'), ('*','_'),
-                   ('$','_')]
-    strip_from_end = [' '] # Strip any of these characters from the end of the string
+    subs = SANITISE_SUBSTITUTIONS
+    # Already clean? Most names are, so return without building anything.
+    if not SANITISE_ILLEGAL_RE.search(in_string) and \
+       not in_string.endswith(SANITISE_STRIP_FROM_END):
+        result = SanitiseResult(in_string, in_string, 0, lazy=True)
+        result['subs_made'] = set()
+        result['positions'] = []
+        return result
+
+    out_string = SANITISE_ILLEGAL_RE.sub(lambda m: subs[m.group()], in_string)
+
+    #Count the characters at the end of the string which end up as one of
+    #strip_from_end, and remove these from the end of the output.
     strip_count = 0
-    strip_chars_found = []
-    subs_made = set() #Any characters which have been substituted. Here to catch ':'
-    positions = []
-    out_strings = []
-
-    """Go through the input string character by character,
-    constructing on output list which can be joined to form out output.
-    This meticulous approach allows us to identify
-    which characters were exchanged, and where. """
-    for n, char in enumerate(in_string):
-        to_append = char
-        #Remove characters from the blacklist
-        if char in black_list:
-            subs_made.add(char)
-            positions.append(n)
-            to_append = ''
-        #Substitute any non-space whitespace with spaces
-        if char in whitespace and char != " ":
-            subs_made.add("Whitespace(" + repr(char) + ")")
-            positions.append(n)
-            to_append = ' '
-        #Make any replacements (e.g ':' for '-')
-        for rl in replace_list:
-            replace_in = rl[0]
-            replace_out = rl[1]
-            if char == replace_in:
-                subs_made.add(char)
-                positions.append(n)
-                to_append = replace_out
-        if to_append in strip_from_end:
-            strip_count += 1
-            strip_chars_found.append(char)
-        else:
-            strip_count = 0
-            strip_chars_found = []
-        out_strings.append(to_append)
-    out_string = ''.join(out_strings)
-    #If we've found any characters to strip, remove these from the end of the string.
+    for char in reversed(in_string):
+        if subs.get(char, char) not in SANITISE_STRIP_FROM_END:
+            break
+        strip_count += 1
     if strip_count > 0:
         out_string = out_string[:-strip_count]
-        for scf in strip_chars_found:
-            subs_made.add(scf)
-        for r in range(strip_count):
-            positions.append(len(in_string) - r - 1)
-    return {'out_string':out_string,
-            'subs_made':subs_made,
-            'positions':positions}
+    return SanitiseResult(in_string, out_string, strip_count, lazy=lazy)
+
+def _build_sanitise_lut():
+    """Return a 256 entry NumPy table mapping each byte to the byte sanitise()
+    would replace it with, or None if NumPy isn't available or the rules
+    can't be expressed byte for byte (e.g deletions from the blacklist).
+
+    """
+    if numpy is None:
+        return None
+    lut = numpy.arange(256, dtype=numpy.uint8)
+    for char, replacement in SANITISE_SUBSTITUTIONS.items():
+        if len(replacement) != 1 or ord(char) > 127:
+            return None
+        lut[ord(char)] = ord(replacement)
+    return lut
+
+SANITISE_LUT = _build_sanitise_lut()
+
+def sanitise_many(names, sanitiser=sanitise):
+    """Sanitise a whole directory listing at once.
+
+    Returns a tuple of the sanitised names and a list of booleans which are
+    True for each name that sanitising changed. Clean names are picked out
+    with a single pass of SANITISE_LUT over the encoded listing, so sanitiser
+    (and the detail it works out) is only called for names which changed.
+    Falls back to calling sanitiser on every name if NumPy is unavailable.
+
+    names : list : str
+        The names to be processed
+    sanitiser : function
+        Default: sanitise
+        Called on each changed name to produce its sanitised version.
+
+    """
+    if SANITISE_LUT is None or not names:
+        out_names = [sanitiser(n)['out_string'] for n in names]
+        return out_names, [o != n for o, n in zip(out_names, names)]
+
+    encoded = [n if isinstance(n, bytes) else n.encode('utf-8') for n in names]
+    width = max([len(e) for e in encoded]) or 1
+    buf = numpy.array(encoded, dtype='S%d' % width).view(numpy.uint8)
+    buf = buf.reshape(len(encoded), width)
+    mapped = SANITISE_LUT[buf]
+    changed = (mapped != buf).any(axis=1)
+    # Names are padded with nulls, so the last real byte is at length - 1.
+    lengths = (buf != 0).sum(axis=1)
+    last = mapped[numpy.arange(len(encoded)), numpy.maximum(lengths - 1, 0)]
+    strip_codes = [ord(c) for c in SANITISE_STRIP_FROM_END]
+    changed |= numpy.in1d(last, strip_codes) & (lengths > 0)
+
+    out_names = list(names)
+    for i in numpy.flatnonzero(changed):
+        out_names[i] = sanitiser(names[i])['out_string']
+    return out_names, changed.tolist()
+
+class SanitiseCache:
+    """A bounded, least recently used cache in front of sanitise(), so that
+    names which recur throughout a project (Thumbs.db, render.0001.exr, the
+    same folder names in every shot) only need sanitising once per process.
+
+    max_size : int
+        The number of names to remember. 0 disables the cache.
+    hits : int
+        Number of lookups answered from the cache, since the last
+        reset_counts().
+    misses : int
+        Number of lookups which had to call sanitise(), likewise.
+
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+
+    def sanitise(self, in_string):
+        """Return a lazy sanitise(in_string), from the cache if it has been
+        seen. Results are copied on the way out so callers may modify them."""
+        try:
+            result = self._results.pop(in_string)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            result = sanitise(in_string, lazy=True)
+            if self.max_size <= 0:
+                return result
+        # (Re)insert as the most recently used entry
+        self._results[in_string] = result
+        if len(self._results) > self.max_size:
+            self._results.popitem(last=False)
+        return result.copy()
+
+    def resize(self, max_size):
+        """Change the number of names remembered, evicting the least
+        recently used if necessary. 0 disables the cache."""
+        self.max_size = max_size
+        while self._results and len(self._results) > max(max_size, 0):
+            self._results.popitem(last=False)
+
+    def clear(self):
+        """Forget all cached names and reset the hit and miss counters"""
+        self._results.clear()
+        self.reset_counts()
+
+    def reset_counts(self):
+        self.hits = 0
+        self.misses = 0
+
+def _literal_prefix(pattern):
+    """If pattern, used with re.match, matches exactly those names which
+    start with some literal string, return that string. Otherwise None.
+
+    A trailing optional atom is allowed, since re.match only anchors at the
+    start: '\\._*' matches just what '\\.' does, i.e any name starting '.'.
+
+    """
+    literal = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            if i + 1 == len(pattern) or pattern[i + 1].isalnum():
+                return None # A character class such as \d, or a backreference
+            char = pattern[i + 1]
+            i += 2
+        elif char in '.^$*+?{}[]|()':
+            return None
+        else:
+            i += 1
+        if pattern[i:i + 1] in ('*', '?'):
+            # Optional, so only harmless at the very end (perhaps made lazy)
+            if pattern[i + 1:] in ('', '?'):
+                return ''.join(literal)
+            return None
+        if pattern[i:i + 1] in ('+', '{'):
+            return None
+        literal.append(char)
+    return ''.join(literal)
+
+class DeleteMatcher:
+    """Tests names against a list of patterns (as used with re.match) for
+    files to delete, compiled once. Patterns which amount to a literal
+    prefix, such as '\\.DS_Store' and '\\._*', are checked with a single
+    str.startswith call; any others are combined into one regex.
+
+    patterns : list : str
+        Regular expressions, matched against the start of each name
+
+    """
+    def __init__(self, patterns):
+        prefixes = []
+        others = []
+        for pattern in patterns:
+            prefix = _literal_prefix(pattern)
+            if prefix is None:
+                others.append(pattern)
+            else:
+                prefixes.append(prefix)
+        self.prefixes = tuple(prefixes)
+        self.regex = None
+        if others:
+            self.regex = re.compile('|'.join(['(?:' + p + ')'
+                                              for p in others]))
+
+    def matches(self, name):
+        """Return True if name matches any of the patterns"""
+        if self.prefixes and name.startswith(self.prefixes):
+            return True
+        return self.regex is not None and self.regex.match(name) is not None
+
+class PathIndex:
+    """A set of paths, hashed by directory, so that adding and looking up a
+    path is O(1) however many have been recorded. Used to keep track of
+    names seen while sanitising a project.
+
+    fold_case : bool
+        If True, paths are compared case insensitively.
+
+    """
+    def __init__(self, fold_case=False):
+        self.fold_case = fold_case
+        self._dirs = {}
+
+    def _split(self, path):
+        if self.fold_case:
+            path = path.lower()
+        return os.path.split(path)
+
+    def add(self, path):
+        directory, name = self._split(path)
+        self._dirs.setdefault(directory, set()).add(name)
+
+    def discard(self, path):
+        directory, name = self._split(path)
+        names = self._dirs.get(directory)
+        if names is not None:
+            names.discard(name)
+
+    def __contains__(self, path):
+        directory, name = self._split(path)
+        return name in self._dirs.get(directory, ())
+
+    def __len__(self):
+        return sum([len(names) for names in self._dirs.values()])
+
+    def clear(self):
+        self._dirs.clear()
+
+class DirectoryCache:
+    """In-memory directory listings, used to find free '(n)' suffixes for
+    clashing names without probing the filesystem for every candidate.
+
+    Each directory is listed once, the first time it is asked about, and is
+    then kept up to date by add(), discard() and rename(). A next-free-suffix
+    counter is kept for each name, so a folder in which hundreds of files
+    sanitise to the same name costs one listing rather than O(k^2) stats.
+
+    fold_case : bool
+        If True, names are compared case insensitively, as they are on the
+        (HFS+ or SMB) filesystems the archive usually lives on.
+
+    """
+    def __init__(self, fold_case=False):
+        self.fold_case = fold_case
+        self._listings = {}
+        self._next_suffix = {}
+
+    def _fold(self, name):
+        return name.lower() if self.fold_case else name
+
+    def _split(self, path):
+        directory, name = os.path.split(path)
+        return directory, self._fold(name)
+
+    def names(self, directory):
+        """Return the set of names in directory, listing it if need be"""
+        try:
+            return self._listings[directory]
+        except KeyError:
+            try:
+                names = set([self._fold(n) for n in os.listdir(directory)])
+            except OSError:
+                names = set()
+            self._listings[directory] = names
+            return names
+
+    def exists(self, path):
+        directory, name = self._split(path)
+        return name in self.names(directory)
+
+    def add(self, path):
+        directory, name = self._split(path)
+        self.names(directory).add(name)
+
+    def discard(self, path):
+        directory, name = self._split(path)
+        self.names(directory).discard(name)
+
+    def rename(self, old_path, new_path):
+        self.discard(old_path)
+        self.add(new_path)
+
+    def append_index(self, name, extension, directory, taken=()):
+        """Return the first path of the form 'directory/name(n)extension'
+        which is neither in directory nor in taken, and reserve it.
+        A drop in replacement for swisspy.append_index.
+
+        name : str
+            The name, without extension, to be suffixed
+        extension : str
+            Any extension (including the '.') to follow the suffix
+        directory : str : path
+            The directory in which the name is to be free
+        taken : container : paths
+            Any other paths which may not be used (e.g those already
+            suggested in a dry run)
+
+        """
+        names = self.names(directory)
+        key = (directory, name, extension)
+        n = self._next_suffix.get(key, 1)
+        while True:
+            candidate = "{0}({1}){2}".format(name, n, extension)
+            path = os.path.join(directory, candidate)
+            if self._fold(candidate) not in names and path not in taken:
+                break
+            n += 1
+        self._next_suffix[key] = n + 1
+        names.add(self._fold(candidate))
+        return path
+
+    def clear(self):
+        self._listings.clear()
+        self._next_suffix.clear()
+
+class RenamePlan:
+    """The renames needed to sanitise a project, worked out in full before
+    any of them are made.
+
+    Paths are stored relative to the project directory, so a plan saved
+    during a dry run can be applied by a later --dorename run without
+    working it out again - as long as the project hasn't changed since.
+
+    root : str : path
+        The project directory the plan applies to
+    entries : list : tuples
+        (path relative to root, new name, 'file' or 'dir'), in the order
+        they were planned
+    digest : str
+        tree_digest() of the project as planned, or None
+    applied : set
+        The paths (relative to root) of the entries already renamed by an
+        earlier run which was interrupted - see load().
+
+    """
+    def __init__(self, root):
+        self.root = root
+        self.entries = []
+        self.digest = None
+        self.applied = set()
+
+    @staticmethod
+    def tree_digest(tree):
+        """Return a digest of every name, size and modification time in
+        tree (a ScannedTree), which changes if anything is added, removed,
+        renamed or rewritten."""
+        digest = hashlib.md5()
+        for entry in sorted(tree.entries()):
+            digest.update(repr(entry) + '\n')
+        return digest.hexdigest()
+
+    def add(self, path, new_name, obj_type):
+        """Record that path (absolute, within root) should be renamed to
+        new_name."""
+        self.entries.append((path[len(self.root) + 1:], new_name, obj_type))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def in_apply_order(self):
+        """Return the entries deepest first, so that nothing is renamed
+        before its contents are."""
+        return sorted(self.entries, key=lambda e: e[0].count(os.sep),
+                      reverse=True)
+
+    def is_applicable(self, tree):
+        """Return True if tree (a fresh ScannedTree of root) is as it was
+        when the plan was made, apart from the renames already applied;
+        every other path the plan renames is present, and none of their
+        new names are taken."""
+        if self.applied:
+            # Undo the renames made, shallowest first, in a copy of tree
+            tree = ScannedTree.from_entries(tree.root, tree.entries())
+            for rel_path, new_name, obj_type in \
+                    reversed(self.in_apply_order()):
+                if rel_path in self.applied:
+                    tree.rename(os.path.join(os.path.dirname(rel_path),
+                                             new_name),
+                                os.path.basename(rel_path))
+        if self.digest is None or self.digest != self.tree_digest(tree):
+            return False
+        for rel_path, new_name, obj_type in self.entries:
+            if rel_path in self.applied:
+                continue
+            target = os.path.join(self.root, os.path.dirname(rel_path),
+                                  new_name)
+            if not os.path.lexists(os.path.join(self.root, rel_path)) or \
+               os.path.lexists(target):
+                return False
+        return True
+
+    def save(self, plan_file):
+        """Write the plan to plan_file: its digest, then one entry per
+        line"""
+        with open(plan_file, 'w') as pf:
+            if self.digest is not None:
+                pf.write(repr(('tree', self.digest)) + '\n')
+            for entry in self.entries:
+                pf.write(repr(entry) + '\n')
+
+    @classmethod
+    def load(cls, plan_file, root, journal_file=None):
+        """Read a plan written by save(), to be applied to root.
+
+        journal_file : str : path
+            If given, the TransferJournal in which an earlier attempt at
+            applying the plan recorded ('renamed', path) for each rename
+            it made. Those renames are marked applied.
+
+        """
+        plan = cls(root)
+        if journal_file is not None:
+            plan.applied = set([e[1] for e in
+                                TransferJournal(journal_file).read()
+                                if e[0] == 'renamed'])
+        with open(plan_file, 'r') as pf:
+            for line in pf:
+                if not line.strip():
+                    continue
+                entry = literal_eval(line)
+                if entry[0] == 'tree' and len(entry) == 2:
+                    plan.digest = entry[1]
+                else:
+                    plan.entries.append(entry)
+        return plan
+
+class TransferJournal:
+    """An append-only record of a project's transfer to the archive, kept
+    in .Hidden beside the project, so that a transfer interrupted by the
+    process being killed can be resumed rather than redone.
+
+    Each line is the repr of one entry:
+        ('transfer', source, dest)   - the transfer has begun
+        ('item', path, log as, target) - path is to be moved to target
+        ('same', path)               - path is already in the archive, and
+                                       is to be removed once all is moved
+        ('done', path)               - path (an item, or a file within one)
+                                       has been moved
+    The journal is removed once the transfer has finished or failed, so
+    while it exists, the transfer is in progress. Entries are flushed as
+    they are written, so they survive the process being killed (though not
+    necessarily the machine going down). A last line cut short by the
+    process being killed is ignored.
+
+    path : str : path
+        The journal file
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock() # Files may be moved in many threads
+
+    @staticmethod
+    def path_for(hidden_dir, folder):
+        """Return the path of the journal for project folder"""
+        return os.path.join(hidden_dir, TRANSFER_JOURNAL_PREFIX + folder)
+
+    def write(self, *entry):
+        """Append entry to the journal"""
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a+')
+                self._file.seek(0, os.SEEK_END)
+                if self._file.tell():
+                    self._file.seek(-1, os.SEEK_END)
+                    last = self._file.read(1)
+                    self._file.seek(0, os.SEEK_END)
+                    if last != '\n':
+                        self._file.write('\n') # After a line cut short
+            self._file.write(repr(entry) + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def read(self):
+        """Return the entries written so far"""
+        entries = []
+        try:
+            with open(self.path, 'r') as jf:
+                for line in jf:
+                    try:
+                        entries.append(literal_eval(line))
+                    except (SyntaxError, ValueError):
+                        pass # Cut short
+        except IOError:
+            pass
+        return entries
+
+    def in_progress(self):
+        """Return True if the journal records a transfer begun (and, since
+        the journal still exists, not yet over)."""
+        entries = self.read()
+        return bool(entries) and entries[0][0] == 'transfer'
+
+def _list_dir(path, with_stats):
+    """Return a list of (name, is_dir, is_link, stat) for the entries in path,
+    using os.scandir where available. stat is None for directories, or if
+    with_stats is False."""
+    entries = []
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                is_dir = entry.is_dir()
+                st = None
+                if with_stats and not is_dir:
+                    st = entry.stat()
+                entries.append((entry.name, is_dir, entry.is_symlink(), st))
+            except OSError:
+                pass # Vanished since listing
+    else:
+        # One lstat per entry, and a stat only to follow a link
+        for name in os.listdir(path):
+            full_path = os.path.join(path, name)
+            try:
+                st = os.lstat(full_path)
+                is_link = stat.S_ISLNK(st.st_mode)
+                if is_link:
+                    try:
+                        st = os.stat(full_path)
+                    except OSError:
+                        if with_stats:
+                            raise # A broken link, which scandir skips too
+                is_dir = stat.S_ISDIR(st.st_mode)
+                if is_dir or not with_stats:
+                    st = None
+                entries.append((name, is_dir, is_link, st))
+            except OSError:
+                pass
+    return entries
+
+def _stat_all(paths, threads=8, batch_size=64):
+    """Return os.stat() of each of paths (None for any which can't be),
+    batch_size at a time in up to threads threads, so that on a network
+    filesystem many round trips are waited on at once."""
+    batches = [paths[i:i + batch_size]
+               for i in range(0, len(paths), batch_size)]
+
+    def stat_batch(batch):
+        stats = []
+        for path in batch:
+            try:
+                stats.append(os.stat(path))
+            except OSError:
+                stats.append(None)
+        return stats
+
+    if threads <= 1 or len(batches) <= 1:
+        results = map(stat_batch, batches)
+    else:
+        pool = multiprocessing.pool.ThreadPool(min(threads, len(batches)))
+        try:
+            results = pool.map(stat_batch, batches)
+        finally:
+            pool.close()
+            pool.join()
+    return [st for stats in results for st in stats]
+
+class ScannedTree:
+    """An in-memory record of a directory tree - names, types, sizes and
+    modification times - built with a single pass over the filesystem, so
+    that sanitising, conflict detection and logging needn't each walk and
+    stat it again.
+
+    Like os.walk, symbolic links to directories are listed as directories
+    but not descended into, and unreadable directories are skipped.
+
+    root : str : path
+        The directory scanned
+    listing : dict
+        Relative directory path ('' for root) -> ([subdir names], [file names])
+    file_stats : dict
+        Relative file path -> (size, modification time in seconds)
+    links : set
+        Relative paths of the links to directories in the tree
+    fold_case : bool
+        If True, paths are looked up case insensitively, as they are on the
+        (HFS+ or SMB) filesystems the archive usually lives on.
+
+    """
+    def __init__(self, root, with_stats=True, within=None, scan=True,
+                 fold_case=False):
+        """Scan root.
+
+        with_stats : bool
+            If False, files aren't stat'ed until stat() asks for them.
+        within : ScannedTree
+            If given, only descend into directories which also exist in
+            within - e.g to scan just the part of an archive folder which a
+            project will be merged into.
+        scan : bool
+            If False, start empty - see from_entries().
+
+        """
+        self.root = root
+        self.listing = {}
+        self.file_stats = {}
+        self.links = set()
+        self.fold_case = fold_case
+        self._folded = {}
+        if within is not None:
+            within_dirs = set([self._fold(d) for d in within.listing])
+        to_scan = [''] if scan else []
+        while to_scan:
+            rel_dir = to_scan.pop()
+            try:
+                entries = _list_dir(os.path.join(root, rel_dir), with_stats)
+            except OSError:
+                continue
+            dirs = []
+            files = []
+            for name, is_dir, is_link, st in entries:
+                rel_path = os.path.join(rel_dir, name)
+                if is_dir:
+                    dirs.append(name)
+                    if is_link:
+                        self.links.add(rel_path)
+                    elif within is None or \
+                         self._fold(rel_path) in within_dirs:
+                        to_scan.append(rel_path)
+                else:
+                    files.append(name)
+                    if st is not None:
+                        self.file_stats[rel_path] = (st.st_size, st.st_mtime)
+            self.listing[rel_dir] = (dirs, files)
+
+    def _fold(self, rel_path):
+        return rel_path.lower() if self.fold_case else rel_path
+
+    def match(self, rel_path):
+        """Return rel_path as the tree names it. With fold_case, each leading
+        part of rel_path which is in the tree takes the case it has there;
+        the rest is left as it is."""
+        if not self.fold_case or not rel_path:
+            return rel_path
+        matched = ''
+        parts = rel_path.split(os.sep)
+        for i, part in enumerate(parts):
+            try:
+                names = self._folded[matched]
+            except KeyError:
+                dirs, files = self.listing.get(matched, ([], []))
+                names = dict([(n.lower(), n) for n in dirs + files])
+                self._folded[matched] = names
+            name = names.get(part.lower())
+            if name is None:
+                return os.path.join(matched, *parts[i:])
+            matched = os.path.join(matched, name)
+        return matched
+
+    def exists(self, rel_path):
+        """Return True if rel_path was found by the scan"""
+        rel_path = self.match(rel_path)
+        if rel_path in self.listing:
+            return True
+        rel_dir, name = os.path.split(rel_path)
+        contents = self.listing.get(rel_dir)
+        return contents is not None and (name in contents[1] or
+                                         name in contents[0])
+
+    def stat(self, rel_path):
+        """Return (size, modification time) for the file at rel_path,
+        stat'ing it now if the scan didn't."""
+        rel_path = self.match(rel_path)
+        try:
+            return self.file_stats[rel_path]
+        except KeyError:
+            st = os.stat(os.path.join(self.root, rel_path))
+            self.file_stats[rel_path] = (st.st_size, st.st_mtime)
+            return self.file_stats[rel_path]
+
+    @classmethod
+    def from_entries(cls, root, entries, fold_case=False):
+        """Build a tree from a record of it rather than from the filesystem.
+
+        entries : iterable
+            (relative path, kind, size, modification time), where kind is
+            'dir', 'link' (a link to a directory, which is listed but not
+            descended into) or 'file'. The root itself is ''.
+
+        """
+        tree = cls(root, scan=False, fold_case=fold_case)
+        for rel_path, kind, size, m_time in entries:
+            if kind == 'dir':
+                tree.listing.setdefault(rel_path, ([], []))
+            if not rel_path:
+                continue
+            rel_dir, name = os.path.split(rel_path)
+            dirs, files = tree.listing.setdefault(rel_dir, ([], []))
+            if kind == 'file':
+                files.append(name)
+                tree.file_stats[rel_path] = (size, m_time)
+            else:
+                dirs.append(name)
+                if kind == 'link':
+                    tree.links.add(rel_path)
+        return tree
+
+    def entries(self, rel_dirs=None):
+        """Return (relative path, kind, size, modification time) for each
+        of rel_dirs (default: every scanned directory) and its contents, in
+        the form from_entries() takes. Sizes and times are None for
+        directories."""
+        if rel_dirs is None:
+            rel_dirs = self.listing
+        entries = []
+        for rel_dir in rel_dirs:
+            entries.append((rel_dir, 'dir', None, None))
+            dirs, files = self.listing[rel_dir]
+            for d in dirs:
+                rel_path = os.path.join(rel_dir, d)
+                if rel_path in self.links:
+                    entries.append((rel_path, 'link', None, None))
+                elif rel_path not in self.listing:
+                    entries.append((rel_path, 'unscanned', None, None))
+            for f in files:
+                rel_path = os.path.join(rel_dir, f)
+                size, m_time = self.stat(rel_path)
+                entries.append((rel_path, 'file', size, m_time))
+        return entries
+
+    def stat_many(self, rel_paths, threads=8, batch_size=64):
+        """Stat any of rel_paths which the scan didn't, batch_size at a time
+        in up to threads threads, so that on a network filesystem many
+        round trips are waited on at once. Files which can't be stat'ed are
+        left for stat() to raise on.
+
+        """
+        wanted = [r for r in [self.match(p) for p in rel_paths]
+                  if r not in self.file_stats]
+        stats = _stat_all([os.path.join(self.root, r) for r in wanted],
+                          threads, batch_size)
+        for rel_path, st in zip(wanted, stats):
+            if st is not None:
+                self.file_stats[rel_path] = (st.st_size, st.st_mtime)
+
+    def abs_path(self, rel_path):
+        """Return the absolute path of rel_path (which may be '' for root)"""
+        if not rel_path:
+            return self.root
+        return os.path.join(self.root, rel_path)
+
+    def walk(self, topdown=True):
+        """Like os.walk(root), but from memory. As with os.walk, when
+        topdown is True the dirs list may be pruned to skip subtrees."""
+        if '' not in self.listing:
+            return
+        if topdown:
+            to_visit = ['']
+            while to_visit:
+                rel_dir = to_visit.pop(0)
+                dirs, files = self.listing[rel_dir]
+                dirs = dirs[:]
+                yield self.abs_path(rel_dir), dirs, files[:]
+                to_visit[0:0] = [os.path.join(rel_dir, d) for d in dirs
+                                 if os.path.join(rel_dir, d) in self.listing]
+        else:
+            for rel_dir in self.dirs_bottom_up():
+                dirs, files = self.listing[rel_dir]
+                yield self.abs_path(rel_dir), dirs[:], files[:]
+
+    def dirs_bottom_up(self):
+        """Return the relative paths of all scanned directories, deepest
+        first, ending with the root ('')."""
+        order = []
+        to_visit = ['']
+        while to_visit:
+            rel_dir = to_visit.pop()
+            order.append(rel_dir)
+            to_visit.extend([os.path.join(rel_dir, d)
+                             for d in self.listing[rel_dir][0]
+                             if os.path.join(rel_dir, d) in self.listing])
+        order.reverse()
+        return order
+
+    def file_paths(self, under=None):
+        """Return the absolute paths of every file in the tree, with root
+        replaced by under if given."""
+        base = under if under is not None else self.root
+        paths = []
+        for rel_dir in sorted(self.listing):
+            for f in self.listing[rel_dir][1]:
+                paths.append(os.path.join(base, rel_dir, f))
+        return paths
+
+    def remove(self, rel_path):
+        """Forget the file at rel_path (e.g once it has been deleted)"""
+        self._folded = {}
+        rel_dir, name = os.path.split(rel_path)
+        contents = self.listing.get(rel_dir)
+        if contents is not None and name in contents[1]:
+            contents[1].remove(name)
+        self.file_stats.pop(rel_path, None)
+
+    def rename(self, old_rel_path, new_name):
+        """Record that the entry at old_rel_path has been renamed new_name,
+        along with everything beneath it. Only the entries beneath a renamed
+        directory are visited, found through its listing, so that renaming
+        every entry in a tree costs no more than walking it."""
+        self._folded = {}
+        rel_dir, old_name = os.path.split(old_rel_path)
+        new_rel_path = os.path.join(rel_dir, new_name)
+        dirs, files = self.listing.get(rel_dir, ([], []))
+        if old_name in files:
+            files[files.index(old_name)] = new_name
+            if old_rel_path in self.file_stats:
+                self.file_stats[new_rel_path] = \
+                    self.file_stats.pop(old_rel_path)
+            return
+        if old_name in dirs:
+            dirs[dirs.index(old_name)] = new_name
+        to_move = [(old_rel_path, new_rel_path)]
+        while to_move:
+            old_path, new_path = to_move.pop()
+            if old_path in self.links:
+                self.links.discard(old_path)
+                self.links.add(new_path)
+            contents = self.listing.pop(old_path, None)
+            if contents is None:
+                continue # A link, or not scanned
+            self.listing[new_path] = contents
+            sub_dirs, sub_files = contents
+            for name in sub_files:
+                old_file = os.path.join(old_path, name)
+                if old_file in self.file_stats:
+                    self.file_stats[os.path.join(new_path, name)] = \
+                        self.file_stats.pop(old_file)
+            for name in sub_dirs:
+                to_move.append((os.path.join(old_path, name),
+                                os.path.join(new_path, name)))
+
+class _SQLiteStore:
+    """Shared by the SQLite files kept by many threads and, with --workers,
+    many processes. Each thread, and each process, uses a connection of
+    its own, and each process a lock of its own: one inherited through a
+    fork may have been held by a thread that the fork didn't copy.
+
+    Subclasses create their tables in _create().
+
+    """
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._local = threading.local()
+        self._lock = None
+        self._lock_pid = None
+
+    def _create(self, conn):
+        """Create the tables, if conn's database doesn't have them yet"""
+        raise NotImplementedError
+
+    @property
+    def connection(self):
+        """This thread's connection"""
+        if getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_file, timeout=60)
+            self._create(conn)
+            conn.commit()
+            self._local.connection = conn
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    @property
+    def lock(self):
+        """This process's lock"""
+        if self._lock_pid != os.getpid():
+            self._lock = threading.Lock()
+            self._lock_pid = os.getpid()
+        return self._lock
+
+class ArchiveIndex(_SQLiteStore):
+    """An on-disk SQLite catalogue of the archive (pass_dir) - every file's
+    size and modification time, and every directory's modification time -
+    so that a merge can find what the archive already holds without listing
+    and stat'ing it over the network. (Files' hashes are kept by HashCache.)
+
+    The catalogue is only trusted for a directory whose modification time
+    is still the one recorded, which catches files added, removed or
+    renamed out of band at the cost of one stat per directory; anything
+    else is rescanned. reconcile() - run in the background by
+    start_reconcile() - catches the rest, e.g files rewritten in place, but
+    isn't relied on: a merge stats the archive files it clashes with.
+
+    db_file : str : path
+        The catalogue
+    root : str : path
+        The archive it describes. Paths within it are stored relative to it.
+
+    """
+    def __init__(self, db_file, root):
+        if sqlite3 is None:
+            raise ImportError("An archive index needs the sqlite3 module")
+        _SQLiteStore.__init__(self, db_file)
+        self.root = root
+        self.reconcile_thread = None
+
+    def _create(self, conn):
+        conn.text_factory = str # Paths are byte strings, in any encoding
+        conn.execute("CREATE TABLE IF NOT EXISTS entries "
+                     "(path TEXT PRIMARY KEY, parent TEXT NOT NULL, "
+                     "kind TEXT NOT NULL, size INTEGER, mtime REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS entries_parent "
+                     "ON entries (parent)")
+
+    def _rows_under(self, rel_dir):
+        """Return every (path, kind, size, mtime) at or beneath rel_dir"""
+        # '0' sorts immediately after '/', so this is everything in rel_dir/
+        return self.connection.execute(
+            "SELECT path, kind, size, mtime FROM entries "
+            "WHERE path = ? OR (path >= ? AND path < ?)",
+            (rel_dir, rel_dir + '/', rel_dir + '0')).fetchall()
+
+    def tree(self, rel_dir, within=None, threads=8, fold_case=False):
+        """Return a ScannedTree of rel_dir built from the catalogue, or None
+        if it isn't catalogued or has changed since.
+
+        within : ScannedTree
+            If given, only directories which also exist in within are
+            checked for changes - e.g those a project will be merged into.
+        fold_case : bool
+            Passed on to the tree, and used in comparing it with within.
+
+        """
+        rows = self._rows_under(rel_dir)
+        dir_times = dict((r[0], r[3]) for r in rows if r[1] == 'dir')
+        if rel_dir not in dir_times:
+            return None
+        prefix = len(rel_dir) + 1 if rel_dir else 0
+        tree = ScannedTree.from_entries(
+            os.path.join(self.root, rel_dir),
+            [(r[0][prefix:], r[1], r[2], r[3]) for r in rows], fold_case)
+        if within is not None:
+            within_dirs = set([tree._fold(d) for d in within.listing])
+        to_check = [d for d in tree.listing
+                    if within is None or tree._fold(d) in within_dirs]
+        stats = _stat_all([tree.abs_path(d) for d in to_check], threads)
+        for rel_path, st in zip(to_check, stats):
+            recorded = dir_times.get(os.path.join(rel_dir, rel_path)
+                                     if rel_path else rel_dir)
+            if st is None or recorded is None or st.st_mtime != recorded:
+                return None
+        return tree
+
+    def record_tree(self, tree, rel_dir, threads=8, scanned_at=None):
+        """Bring the catalogue's record of each directory listed in tree (a
+        tree of rel_dir) into line with tree. Directories beneath which tree
+        doesn't list are left as they are.
+
+        scanned_at : float
+            When tree was scanned. A directory changed since then may have
+            changed after it was listed, so isn't trusted next time.
+
+        """
+        rows = {}
+        for rel_path, kind, size, m_time in tree.entries():
+            path = os.path.join(rel_dir, rel_path) if rel_path else rel_dir
+            rows[path] = (path, os.path.dirname(path), kind, size, m_time)
+        listed = sorted(p for p in rows if rows[p][2] == 'dir')
+        stats = _stat_all([os.path.join(self.root, p) for p in listed],
+                          threads)
+        for path, st in zip(listed, stats):
+            m_time = st.st_mtime if st is not None else None
+            if m_time is not None and scanned_at is not None and \
+               m_time >= scanned_at - 1:
+                m_time = None
+            rows[path] = rows[path][:4] + (m_time,)
+        with self.lock:
+            conn = self.connection
+            for path in listed:
+                for child, kind in conn.execute(
+                        "SELECT path, kind FROM entries WHERE parent = ?",
+                        (path,)).fetchall():
+                    if child not in rows:
+                        conn.execute("DELETE FROM entries WHERE path = ? OR "
+                                     "(path >= ? AND path < ?)",
+                                     (child, child + '/', child + '0'))
+            # Directories which tree knows of but didn't list keep their
+            # record if they have one, and are otherwise marked unchecked.
+            conn.executemany("INSERT OR IGNORE INTO entries "
+                             "(path, parent, kind) VALUES (?, ?, 'dir')",
+                             [r[:2] for r in rows.values()
+                              if r[2] == 'unscanned'])
+            conn.executemany("INSERT OR REPLACE INTO entries "
+                             "(path, parent, kind, size, mtime) "
+                             "VALUES (?, ?, ?, ?, ?)",
+                             [r for r in rows.values()
+                              if r[2] != 'unscanned'])
+            conn.commit()
+
+    def forget(self, rel_dir):
+        """Remove rel_dir and everything beneath it from the catalogue"""
+        with self.lock:
+            conn = self.connection
+            conn.execute("DELETE FROM entries WHERE path = ? OR "
+                         "(path >= ? AND path < ?)",
+                         (rel_dir, rel_dir + '/', rel_dir + '0'))
+            conn.commit()
+
+    def reconcile(self, threads=8):
+        """Rescan each folder in the archive in turn, bringing the
+        catalogue up to date with it."""
+        try:
+            folders = swisspy.immediate_subdirs(self.root)
+        except OSError:
+            return
+        catalogued = self.connection.execute(
+            "SELECT path FROM entries WHERE parent = ''").fetchall()
+        for (folder,) in catalogued:
+            if folder not in folders:
+                self.forget(folder)
+        for folder in folders:
+            path = os.path.join(self.root, folder)
+            if os.path.isdir(path):
+                scanned_at = time.time()
+                self.record_tree(ScannedTree(path), folder, threads,
+                                 scanned_at)
+            else:
+                self.forget(folder)
+
+    def start_reconcile(self, interval=3600, threads=8, log_files=(),
+                        quiet=False):
+        """Run reconcile() in a background thread every interval seconds,
+        logging any failure to log_files."""
+        def run():
+            while True:
+                try:
+                    self.reconcile(threads)
+                except Exception as e:
+                    swisspy.print_and_log("Archive index reconcile failed: "
+                                          "{0}\n".format(e), list(log_files),
+                                          ts="long", quiet=quiet)
+                time.sleep(interval)
+        self.reconcile_thread = threading.Thread(target=run)
+        self.reconcile_thread.daemon = True
+        self.reconcile_thread.start()
+        return self.reconcile_thread
+
+class HashCache(_SQLiteStore):
+    """A persistent record of files' hashes, so that archive files needn't
+    be hashed again each time a project clashes with them. Entries are
+    keyed on (device, inode, size, modification time in nanoseconds) as
+    well as the algorithm, so any change to a file - or a different file
+    at the same path - misses.
+
+    Entries for files which have since been removed or changed can't be
+    recognised as such, so instead each records when it was last used, and
+    those unused for max_age seconds are pruned every PRUNE_EVERY puts. The
+    cache stays the size of the part of the archive projects clash with.
+
+    db_file : str : path
+        The cache
+    max_age : float
+        Seconds for which an unused entry is kept. Default: 30 days.
+    hits, misses : int
+        Lookups which did and didn't find a hash, since the last
+        reset_counts().
+
+    """
+    PRUNE_EVERY = 1000
+
+    def __init__(self, db_file, max_age=30 * 24 * 3600):
+        if sqlite3 is None:
+            raise ImportError("A hash cache needs the sqlite3 module")
+        _SQLiteStore.__init__(self, db_file)
+        self.max_age = max_age
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _create(self, conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS hashes "
+                     "(dev INTEGER, ino INTEGER, size INTEGER, "
+                     "mtime_ns INTEGER, algorithm TEXT, hash TEXT, "
+                     "used REAL, "
+                     "PRIMARY KEY (dev, ino, size, mtime_ns, algorithm))")
+        columns = [c[1] for c in
+                   conn.execute("PRAGMA table_info(hashes)").fetchall()]
+        if 'used' not in columns: # Made before entries were pruned
+            conn.execute("ALTER TABLE hashes ADD COLUMN used REAL")
+        conn.execute("CREATE INDEX IF NOT EXISTS hashes_used "
+                     "ON hashes (used)")
+
+    @staticmethod
+    def key(st):
+        """Return the cache key for a file, given os.stat() of it"""
+        mtime_ns = getattr(st, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(round(st.st_mtime * 10 ** 9))
+        return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+    def get(self, key, algorithm):
+        """Return the hash recorded for key, or None"""
+        now = time.time()
+        try:
+            conn = self.connection
+            row = conn.execute(
+                "SELECT hash, used FROM hashes WHERE dev = ? AND ino = ? AND "
+                "size = ? AND mtime_ns = ? AND algorithm = ?",
+                key + (algorithm,)).fetchone()
+            # Only note the use if it matters to pruning, to save writes
+            if row is not None and (row[1] is None or
+                                    now - row[1] > self.max_age / 10.0):
+                conn.execute("UPDATE hashes SET used = ? WHERE dev = ? AND "
+                             "ino = ? AND size = ? AND mtime_ns = ? AND "
+                             "algorithm = ?", (now,) + key + (algorithm,))
+                conn.commit()
+        except sqlite3.Error:
+            row = None # The cache is only an optimisation
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return str(row[0])
+
+    def put(self, key, algorithm, digest):
+        """Record digest as the hash of key. Any older entry for the same
+        inode is replaced, since it can no longer be looked up."""
+        try:
+            conn = self.connection
+            conn.execute("DELETE FROM hashes WHERE dev = ? AND ino = ? AND "
+                         "algorithm = ?", (key[0], key[1], algorithm))
+            conn.execute("INSERT OR REPLACE INTO hashes "
+                         "(dev, ino, size, mtime_ns, algorithm, hash, used) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         key + (algorithm, digest, time.time()))
+            conn.commit()
+        except sqlite3.Error:
+            pass
+        self._puts += 1
+        if self._puts % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def prune(self):
+        """Remove the entries which haven't been used for self.max_age
+        seconds"""
+        try:
+            conn = self.connection
+            conn.execute("DELETE FROM hashes WHERE used IS NULL OR used < ?",
+                         (time.time() - self.max_age,))
+            conn.commit()
+        except sqlite3.Error:
+            pass
+
+    def reset_counts(self):
+        self.hits = 0
+        self.misses = 0
+
+class ContentHasher:
+    """Hashes files' contents, many files at once.
+
+    Files are read chunk_size bytes at a time by up to threads threads
+    (hashlib releases the GIL while it works, so they hash in parallel as
+    well as waiting on reads together), with no more than max_in_flight
+    bytes read but not yet hashed at any time.
+
+    algorithm : str
+        Any algorithm hashlib provides, e.g 'md5' or 'blake2b'
+    threads : int
+        Files to hash at once
+    chunk_size : int
+        Bytes to read at a time
+    max_in_flight : int
+        Cap on bytes held in memory across all threads
+    cache : HashCache
+        If given, consulted before hashing any file, and kept up to date.
+
+    """
+    def __init__(self, algorithm='md5', threads=4, chunk_size=8 * 1024 ** 2,
+                 max_in_flight=256 * 1024 ** 2, cache=None):
+        hashlib.new(algorithm) # Raises ValueError if unavailable
+        self.algorithm = algorithm
+        self.cache = cache
+        self.threads = max(1, threads)
+        self.chunk_size = chunk_size
+        self._in_flight = threading.BoundedSemaphore(
+            max(1, max_in_flight // chunk_size))
+
+    def hash_file(self, path):
+        """Return the hex digest of the file at path, or None if it can't
+        be read."""
+        digest = hashlib.new(self.algorithm)
+        try:
+            with open(path, 'rb') as f:
+                while True:
+                    with self._in_flight:
+                        chunk = f.read(self.chunk_size)
+                        if not chunk:
+                            break
+                        digest.update(chunk)
+        except (IOError, OSError):
+            return None
+        return digest.hexdigest()
+
+    def _hash_all(self, paths):
+        """Hash each of paths, in parallel, without the cache"""
+        if self.threads == 1 or len(paths) <= 1:
+            return map(self.hash_file, paths)
+        pool = multiprocessing.pool.ThreadPool(min(self.threads, len(paths)))
+        try:
+            return pool.map(self.hash_file, paths, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def hash_files(self, paths):
+        """Return {path: hex digest (or None)} for each of paths"""
+        paths = list(OrderedDict.fromkeys(paths))
+        if self.cache is None:
+            return dict(zip(paths, self._hash_all(paths)))
+        hashes = {}
+        keys = {}
+        for path in paths:
+            try:
+                keys[path] = HashCache.key(os.stat(path))
+            except OSError:
+                hashes[path] = None
+                continue
+            hashes[path] = self.cache.get(keys[path], self.algorithm)
+        to_hash = [p for p in paths if hashes[p] is None and p in keys]
+        for path, digest in zip(to_hash, self._hash_all(to_hash)):
+            hashes[path] = digest
+            try:
+                unchanged = HashCache.key(os.stat(path)) == keys[path]
+            except OSError:
+                unchanged = False
+            if digest is not None and unchanged:
+                self.cache.put(keys[path], self.algorithm, digest)
+        return hashes
+
+class CopyEngine:
+    """Moves and copies files, letting the kernel do the copying where it
+    can, so that data crossing devices needn't pass through Python.
+
+    method : str
+        'reflink'         - clone the file with the FICLONE ioctl, so the
+                            copy shares the original's blocks until either
+                            is changed (e.g on btrfs or XFS, within a
+                            filesystem)
+        'copy_file_range' - copy within the kernel, or server side on a
+                            network filesystem that supports it
+        'sendfile'        - copy within the kernel
+        'python'          - read into and write from a buffer of
+                            block_size bytes, allocated once per thread
+        'auto'            - the first of the above this system supports,
+                            falling back to the next whenever one can't be
+                            used for a particular pair of files
+    block_size : int
+        Bytes to read and write at a time with 'python', at most MAX_BLOCK
+    verify : str
+        If given, the name of a hashlib algorithm to verify copies with:
+        the data is hashed as it is copied (so always with 'python'), then
+        the copy is read back - after dropping it from the page cache, so
+        the read reaches the disk or server - and hashed again. A copy
+        which doesn't match is removed and IOError raised, so that move()
+        leaves the source alone.
+    bytes_copied : dict
+        Method -> bytes copied (or for 'reflink', cloned) with it
+    files_verified : int
+        Copies verified since the last reset_counts()
+    cached_read_backs : int
+        Of those, the copies which couldn't be dropped from the page cache
+        before being read back, so may not have been checked against what
+        was stored
+
+    """
+    METHODS = ('reflink', 'copy_file_range', 'sendfile', 'python')
+    FICLONE = 0x40049409 # _IOW(0x94, 9, int)
+    POSIX_FADV_DONTNEED = 4
+    MAX_CALL = 1024 ** 3 # Most bytes to ask the kernel for at once
+    MAX_BLOCK = 1024 ** 3 # Largest buffer allowed for 'python'
+    # Errors meaning a method can't be used here, rather than that copying
+    # has gone wrong
+    UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                   errno.EBADF, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP))
+
+    def __init__(self, method='auto', block_size=8 * 1024 ** 2, verify=None):
+        if method != 'auto' and method not in self.METHODS:
+            raise ValueError("Unknown copy method: " + method)
+        if verify:
+            hashlib.new(verify) # Raises ValueError if unavailable
+        if block_size < 1:
+            raise ValueError("Block size must be at least 1 byte")
+        self.method = method
+        self.block_size = min(block_size, self.MAX_BLOCK)
+        self.verify = verify
+        self.files_verified = 0
+        self.cached_read_backs = 0
+        self._buffers = threading.local()
+        self.bytes_copied = dict((m, 0) for m in self.METHODS)
+        self._unsupported = set() # Methods this system lacks entirely
+        self._no_reflink = set() # (source, dest) devices which can't clone
+        self._count_lock = threading.Lock() # Copies may run in many threads
+        self._libc = None
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                     use_errno=True)
+        except OSError:
+            pass
+
+    def _kernel_call(self, name, argtypes, restype=ctypes.c_ssize_t):
+        """Return the named libc function, set up for use, or None"""
+        try:
+            function = getattr(self._libc, name)
+        except (AttributeError, TypeError):
+            return None
+        function.argtypes = argtypes
+        function.restype = restype
+        return function
+
+    def _copy_file_range(self, src_fd, dst_fd, remaining):
+        offset = ctypes.POINTER(ctypes.c_int64) # loff_t *
+        function = self._kernel_call('copy_file_range',
+                                     [ctypes.c_int, offset, ctypes.c_int,
+                                      offset, ctypes.c_size_t, ctypes.c_uint])
+        if function is None:
+            raise OSError(errno.ENOSYS, "copy_file_range is unavailable")
+        return function(src_fd, None, dst_fd, None, remaining, 0)
+
+    def _sendfile(self, src_fd, dst_fd, remaining):
+        function = self._kernel_call('sendfile',
+                                     [ctypes.c_int, ctypes.c_int,
+                                      ctypes.POINTER(ctypes.c_int64),
+                                      ctypes.c_size_t])
+        if function is None:
+            raise OSError(errno.ENOSYS, "sendfile is unavailable")
+        return function(dst_fd, src_fd, None, remaining)
+
+    def _count(self, method, n):
+        with self._count_lock:
+            self.bytes_copied[method] += n
+
+    def _reflink(self, src, dst):
+        """Clone src to dst (both open files), returning False if they
+        can't be cloned."""
+        devices = (os.fstat(src.fileno()).st_dev, os.fstat(dst.fileno()).st_dev)
+        if fcntl is None or devices in self._no_reflink:
+            return False
+        try:
+            fcntl.ioctl(dst.fileno(), self.FICLONE, src.fileno())
+        except IOError as e:
+            if e.errno in self.UNSUPPORTED + (errno.ENOTTY,):
+                self._no_reflink.add(devices)
+                return False
+            raise
+        self._count('reflink', os.fstat(src.fileno()).st_size)
+        return True
+
+    def _kernel_copy(self, method, src, dst):
+        """Copy src's contents to dst (both open files) with method,
+        returning False if it can't be used for them.
+
+        The kernel may stop short of the size src had when opened, e.g for
+        pseudo-files, or between some filesystems; the copy so far is then
+        undone, and False returned, so that another method is tried.
+
+        """
+        call = getattr(self, '_' + method)
+        size = os.fstat(src.fileno()).st_size
+        if size == 0:
+            return False # Perhaps a pseudo-file; nothing to gain here anyway
+        copied = 0
+        while True:
+            try:
+                done = call(src.fileno(), dst.fileno(),
+                            min(max(size - copied, self.block_size),
+                                self.MAX_CALL))
+            except OSError as e:
+                done, err = -1, e.errno
+            else:
+                err = ctypes.get_errno() if done < 0 else 0
+            if done < 0:
+                if err == errno.EINTR:
+                    continue
+                if copied == 0 and err in self.UNSUPPORTED:
+                    if err == errno.ENOSYS:
+                        self._unsupported.add(method)
+                    return False
+                raise OSError(err, os.strerror(err), src.name)
+            if done == 0:
+                break # End of file
+            copied += done
+            self._count(method, done)
+        if copied < size:
+            self._count(method, -copied)
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+            return False
+        return True
+
+    def _buffer(self):
+        """Return this thread's buffer"""
+        buf = getattr(self._buffers, 'buf', None)
+        if buf is None or len(buf) != self.block_size:
+            buf = self._buffers.buf = bytearray(self.block_size)
+        return buf
+
+    def _buffered_copy(self, src, dst, digest=None):
+        """Copy src's contents to dst (both open, unbuffered, files) through
+        this thread's buffer, without allocating anything per block, and
+        update digest (a hashlib object) with them if given."""
+        buf = self._buffer()
+        view = memoryview(buf)
+        while True:
+            n = src.readinto(buf)
+            if not n:
+                break
+            if digest is not None:
+                digest.update(view[:n])
+            written = 0
+            while written < n: # Unbuffered writes may be partial
+                count = dst.write(view[written:n])
+                if count is None: # Python 2's file.write writes it all
+                    count = n - written
+                elif count == 0:
+                    raise IOError(errno.EIO, "No bytes written", dst.name)
+                written += count
+            self._count('python', n)
+
+    def _drop_cached(self, f):
+        """Ask the kernel to drop the open file f from the page cache,
+        returning 0 if it did, else an errno."""
+        function = self._kernel_call('posix_fadvise64',
+                                     [ctypes.c_int, ctypes.c_int64,
+                                      ctypes.c_int64, ctypes.c_int],
+                                     ctypes.c_int)
+        if function is None: # off_t is a long wherever this is needed
+            function = self._kernel_call('posix_fadvise',
+                                         [ctypes.c_int, ctypes.c_long,
+                                          ctypes.c_long, ctypes.c_int],
+                                         ctypes.c_int)
+        if function is None:
+            return errno.ENOSYS
+        # Returns the error, rather than setting errno
+        return function(f.fileno(), 0, 0, self.POSIX_FADV_DONTNEED)
+
+    def _read_back(self, path):
+        """Return the hashlib object of the file at path, as stored"""
+        digest = hashlib.new(self.verify)
+        buf = self._buffer()
+        view = memoryview(buf)
+        with open(path, 'rb', 0) as f:
+            os.fsync(f.fileno()) # Dirty pages can't be dropped
+            if self._drop_cached(f) != 0:
+                with self._count_lock:
+                    self.cached_read_backs += 1
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                digest.update(view[:n])
+        return digest
+
+    def _verified_copy(self, src, dst):
+        """Copy src to dst (both paths), verifying the copy"""
+        digest = hashlib.new(self.verify)
+        with open(src, 'rb', 0) as fsrc:
+            with open(dst, 'wb', 0) as fdst:
+                self._buffered_copy(fsrc, fdst, digest)
+        if self._read_back(dst).digest() != digest.digest():
+            os.unlink(dst)
+            raise IOError(errno.EIO, "Copy failed verification", dst)
+        with self._count_lock:
+            self.files_verified += 1
+
+    def copy_file(self, src, dst):
+        """Copy the contents, permissions and times of file src to dst"""
+        if self.verify:
+            self._verified_copy(src, dst)
+            shutil.copystat(src, dst)
+            return
+        with open(src, 'rb', 0) as fsrc:
+            with open(dst, 'wb', 0) as fdst:
+                methods = self.METHODS if self.method == 'auto' \
+                          else (self.method, 'python')
+                for method in methods:
+                    if method in self._unsupported:
+                        continue
+                    if method == 'python':
+                        self._buffered_copy(fsrc, fdst)
+                        break
+                    if method == 'reflink':
+                        if self._reflink(fsrc, fdst):
+                            break
+                    elif self._kernel_copy(method, fsrc, fdst):
+                        break
+        shutil.copystat(src, dst)
+
+    def report(self):
+        """Describe, for the logs, how much has been cloned and copied since
+        the last reset_counts() - or return '' if nothing has."""
+        cloned = self.bytes_copied['reflink']
+        copied = sum(self.bytes_copied.values()) - cloned
+        if not cloned and not copied:
+            return ''
+        report = "{0} bytes cloned, {1} bytes copied.".format(cloned, copied)
+        if self.verify:
+            report += " {0} copies verified with {1}.".format(
+                self.files_verified, self.verify)
+            if self.cached_read_backs:
+                report += (" {0} of them were read back from the page cache "
+                           "(posix_fadvise failed), not from storage."
+                           "".format(self.cached_read_backs))
+        return report + "\n"
+
+    def reset_counts(self):
+        self.bytes_copied = dict((m, 0) for m in self.METHODS)
+        self.files_verified = 0
+        self.cached_read_backs = 0
+
+    def copytree(self, src, dst):
+        """Copy the directory src to dst, which musn't exist, as
+        shutil.copytree(symlinks=True) does."""
+        names = os.listdir(src)
+        os.makedirs(dst)
+        errors = []
+        for name in names:
+            src_name = os.path.join(src, name)
+            dst_name = os.path.join(dst, name)
+            try:
+                if os.path.islink(src_name):
+                    os.symlink(os.readlink(src_name), dst_name)
+                elif os.path.isdir(src_name):
+                    self.copytree(src_name, dst_name)
+                else:
+                    self.copy_file(src_name, dst_name)
+            except shutil.Error as e:
+                errors.extend(e.args[0])
+            except EnvironmentError as e:
+                errors.append((src_name, dst_name, str(e)))
+        try:
+            shutil.copystat(src, dst)
+        except OSError as e:
+            errors.append((src, dst, str(e)))
+        if errors:
+            raise shutil.Error(errors)
+
+    def move(self, src, dst):
+        """Move src to dst, as shutil.move does: by renaming it if possible,
+        and otherwise by copying it (with copy_file or copytree) and then
+        removing it."""
+        real_dst = dst
+        if os.path.isdir(dst):
+            real_dst = os.path.join(dst, os.path.basename(src.rstrip('/')))
+            if os.path.exists(real_dst):
+                raise shutil.Error("Destination path '%s' already exists"
+                                   % real_dst)
+        try:
+            os.rename(src, real_dst)
+        except OSError:
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), real_dst)
+                os.unlink(src)
+            elif os.path.isdir(src):
+                if os.path.abspath(real_dst).startswith(
+                        os.path.join(os.path.abspath(src), '')):
+                    raise shutil.Error("Cannot move a directory '%s' into "
+                                       "itself '%s'." % (src, dst))
+                self.copytree(src, real_dst)
+                shutil.rmtree(src)
+            else:
+                self.copy_file(src, real_dst)
+                os.unlink(src)
+
+class QuiescenceMonitor:
+    """Decides when projects in To Archive have finished arriving.
+
+    Each check takes a snapshot of a project - (entry count, total size,
+    time of the latest change) - and keeps it until the next. A project is
+    ready once nothing has changed for settle_window seconds: on its first
+    check, that is judged from the latest modification or change time found
+    in it, and from then on by comparing snapshots.
+
+    Checks are kept cheap by remembering each directory's figures, along
+    with its own mtime. Every directory is stat'ed on every check, but a
+    directory whose mtime is unchanged and whose newest file had already
+    settled last time has its figures reused rather than its files being
+    listed and stat'ed again. New files always show up, as they change
+    their directory's mtime; a file which had settled and is then rewritten
+    in place will not.
+
+    settle_window : float
+        Seconds for which a project must be unchanged to be ready.
+
+    """
+    def __init__(self, settle_window=30):
+        self.settle_window = settle_window
+        self._projects = {}
+
+    def _snapshot(self, path, previous_dirs, now):
+        """Return (entry count, total size, latest change) for path, and the
+        per-directory figures it was made from."""
+        dirs = {}
+        count = size = latest = 0
+        to_scan = [path]
+        while to_scan:
+            directory = to_scan.pop()
+            try:
+                st = os.stat(directory)
+            except OSError:
+                continue # Vanished
+            figures = previous_dirs.get(directory)
+            if figures is None or figures[0] != st.st_mtime or \
+               now - figures[3] < self.settle_window:
+                dir_count = dir_size = 0
+                newest = max(st.st_mtime, st.st_ctime)
+                subdirs = []
+                try:
+                    entries = _list_dir(directory, with_stats=True)
+                except OSError:
+                    entries = []
+                for name, is_dir, is_link, est in entries:
+                    dir_count += 1
+                    if is_dir:
+                        if not is_link:
+                            subdirs.append(os.path.join(directory, name))
+                    elif est is not None:
+                        dir_size += est.st_size
+                        newest = max(newest, est.st_mtime, est.st_ctime)
+                figures = (st.st_mtime, dir_count, dir_size, newest, subdirs)
+            dirs[directory] = figures
+            count += figures[1]
+            size += figures[2]
+            latest = max(latest, figures[3])
+            to_scan.extend(figures[4])
+        return (count, size, latest), dirs
+
+    def is_ready(self, path, now=None):
+        """Check path again, returning True if it has settled.
+
+        path : str : path
+            The project directory
+        now : float
+            Default: time.time()
+
+        """
+        if now is None:
+            now = time.time()
+        state = self._projects.get(path)
+        snapshot, dirs = self._snapshot(path,
+                                        state['dirs'] if state else {}, now)
+        if state is None:
+            state = {'first_seen': now, 'last_change': min(now, snapshot[2])}
+            self._projects[path] = state
+        elif snapshot != state['snapshot']:
+            state['last_change'] = now
+        state['snapshot'] = snapshot
+        state['dirs'] = dirs
+        return now - state['last_change'] >= self.settle_window
+
+    def size_estimate(self, path):
+        """Total size of path in bytes, as of its last check (else None)"""
+        state = self._projects.get(path)
+        return state['snapshot'][1] if state else None
+
+    def waited(self, path, now=None):
+        """Seconds since path was first checked (0 if it never was). Only
+        meaningful in daemon mode, where one monitor checks projects
+        repeatedly; a run from cron makes a new monitor each time."""
+        state = self._projects.get(path)
+        if state is None:
+            return 0
+        return (now if now is not None else time.time()) - state['first_seen']
+
+    def next_ready_in(self, now=None):
+        """Seconds until the first project yet to settle will have, if
+        nothing in it changes meanwhile, or None if none are waiting."""
+        if now is None:
+            now = time.time()
+        waits = [state['last_change'] + self.settle_window - now
+                 for state in self._projects.values()
+                 if now - state['last_change'] < self.settle_window]
+        return min(waits) if waits else None
+
+    def first_seen(self, path):
+        """When path was first checked, or None if it never was"""
+        state = self._projects.get(path)
+        return state['first_seen'] if state else None
+
+    def forget(self, path):
+        """Drop what's known about path, e.g once it has been processed"""
+        self._projects.pop(path, None)
+
+class ProjectScheduler:
+    """Decides the order in which queued projects are processed.
+
+    policy : str
+        'name'     - alphabetical, as immediate_subdirs() lists them
+        'fifo'     - first seen in To Archive first
+        'shortest' - smallest first
+        'fair'     - the fair_weight smallest, then whichever of the rest
+                     arrived first, and so on; with several workers, large
+                     projects run alongside a stream of small ones, and
+                     none waits for every smaller project to finish.
+    monitor : QuiescenceMonitor
+        Provides size estimates, from projects' latest snapshots, and the
+        times projects were first seen.
+    fair_weight : int
+        With 'fair', the number of small projects per large one.
+    state_file : str : path
+        If given, where projects' arrival times and size estimates are kept
+        between runs - e.g from cron, when each starts with a new monitor.
+
+    """
+    POLICIES = ('name', 'fifo', 'shortest', 'fair')
+
+    def __init__(self, policy='name', monitor=None, fair_weight=3,
+                 state_file=None):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown scheduling policy: " + policy)
+        self.policy = policy
+        self.monitor = monitor if monitor is not None else QuiescenceMonitor()
+        self.fair_weight = max(1, fair_weight)
+        self.state_file = state_file
+        self._arrivals = {} # Path -> when first seen
+        self._sizes = {} # Path -> (its mtime, size estimate)
+        self._load()
+
+    def _load(self):
+        if self.state_file is None:
+            return
+        try:
+            with open(self.state_file, 'r') as sf:
+                for line in sf:
+                    path, arrived, m_time, size = literal_eval(line)
+                    self._arrivals[path] = arrived
+                    if size is not None:
+                        self._sizes[path] = (m_time, size)
+        except (IOError, SyntaxError, ValueError):
+            pass # Start afresh
+
+    def _save(self):
+        """Write out the state of the projects still waiting, dropping the
+        rest."""
+        for path in list(self._arrivals):
+            if not os.path.isdir(path): # Processed
+                del self._arrivals[path]
+                self._sizes.pop(path, None)
+        if self.state_file is None:
+            return
+        temp_file = self.state_file + '.tmp'
+        try:
+            with open(temp_file, 'w') as sf:
+                for path, arrived in sorted(self._arrivals.items()):
+                    m_time, size = self._sizes.get(path, (None, None))
+                    sf.write(repr((path, arrived, m_time, size)) + '\n')
+            os.rename(temp_file, self.state_file)
+        except EnvironmentError:
+            pass # Only the order of later runs suffers
+
+    def size(self, path):
+        """Estimated size of the project at path, in bytes: from the
+        monitor's latest snapshot, or failing that the last estimate made
+        while path had its current mtime, or failing that a new snapshot.
+        Estimates only order projects, so one which misses a change deep
+        within a project will do."""
+        try:
+            m_time = os.stat(path).st_mtime
+        except OSError:
+            return 0
+        size = self.monitor.size_estimate(path)
+        if size is None:
+            cached = self._sizes.get(path)
+            if cached is not None and cached[0] == m_time:
+                return cached[1]
+            self.monitor.is_ready(path)
+            size = self.monitor.size_estimate(path)
+        self._sizes[path] = (m_time, size)
+        return size
+
+    def arrived(self, path):
+        """When the project at path was first seen in To Archive - by the
+        monitor, or by this or an earlier run ordering projects. (Directory
+        times won't do: the ctime and mtime change whenever the project's
+        contents are added to or renamed.)"""
+        if path not in self._arrivals:
+            self._arrivals[path] = self.monitor.first_seen(path) or \
+                                   time.time()
+        return self._arrivals[path]
+
+    def order(self, root, folders):
+        """Return folders, the names of projects within root, in the order
+        they should be processed. Those which arrived together are taken by
+        name."""
+        folders = sorted(folders)
+        if self.policy == 'name':
+            return folders
+        paths = dict((f, os.path.join(root, f)) for f in folders)
+        by_arrival = sorted(folders, key=lambda f: self.arrived(paths[f]))
+        if self.policy == 'fifo' or len(folders) <= 1:
+            ordered = by_arrival
+        else:
+            ordered = self._order_by_size(folders, paths, by_arrival)
+        self._save()
+        return ordered
+
+    def _order_by_size(self, folders, paths, by_arrival):
+        """The 'shortest' or 'fair' order of folders"""
+        by_size = sorted(folders, key=lambda f: self.size(paths[f]))
+        if self.policy == 'shortest':
+            return by_size
+        ordered = []
+        while by_size:
+            for folder in by_size[:self.fair_weight]:
+                ordered.append(folder)
+                by_arrival.remove(folder)
+            del by_size[:self.fair_weight]
+            if by_arrival:
+                folder = by_arrival.pop(0)
+                ordered.append(folder)
+                by_size.remove(folder)
+        return ordered
+
+class InotifyWatcher:
+    """Waits for entries to appear in, change in or leave a directory, using
+    Linux's inotify through ctypes. Where inotify isn't available, wait()
+    just sleeps, so callers fall back to polling.
+
+    path : str : path
+        The directory to watch (not recursively)
+
+    """
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        mask = self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | \
+               self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | \
+               self.IN_DELETE
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init()
+            if fd < 0:
+                return
+            if libc.inotify_add_watch(fd, path.encode(sys.getfilesystemencoding())
+                                      if not isinstance(path, bytes) else path,
+                                      ctypes.c_uint32(mask)) < 0:
+                os.close(fd)
+                return
+            self.fd = fd
+        except (AttributeError, OSError):
+            pass # Not Linux
+
+    @property
+    def available(self):
+        return self.fd is not None
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for a change. Returns True if there was
+        one (what it was doesn't matter), False on timeout."""
+        if self.fd is None:
+            time.sleep(timeout)
+            return False
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+        os.read(self.fd, 65536) # Discard the events themselves
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def block_size_mb(value):
+    """argparse type for --block-size: whole megabytes, from 1 up to
+    CopyEngine.MAX_BLOCK"""
+    try:
+        mb = int(value)
+    except ValueError:
+        mb = 0
+    most = CopyEngine.MAX_BLOCK // 1024 ** 2
+    if not 1 <= mb <= most:
+        raise argparse.ArgumentTypeError("must be a whole number of "
+                                         "megabytes from 1 to {0}, not {1}"
+                                         "".format(most, value))
+    return mb
+
+def hash_algorithm(value):
+    """argparse type for --hash-algorithm: the name of an algorithm which
+    this Python's hashlib provides"""
+    try:
+        hashlib.new(value)
+    except ValueError:
+        available = getattr(hashlib, 'algorithms_available', None) or \
+                    getattr(hashlib, 'algorithms', ())
+        raise argparse.ArgumentTypeError(
+            "{0} isn't available here. Try one of: {1}".format(
+                value, ', '.join(sorted(set(a.lower() for a in available)))))
+    return value
 
 def get_arguments():
     """Return command line arguments from argparse"""
@@ -183,38 +2185,127 @@ def get_arguments():
             "file transfers, by dealing with illegal characters in a "\
             "sensible way. Developed by Josh Smith (joshsmith2@gmail.com)"
     p = argparse.ArgumentParser(description=blurb)
+    p.add_argument('--archive-index', dest='archive_index', metavar='PATH',
+                   help="A SQLite catalogue of the archive, kept up to date "
+                        "as projects are moved and used to find clashes "
+                        "without rescanning it. Default - none.")
+    p.add_argument('--block-size', dest='block_size', metavar='MB',
+                   type=block_size_mb, default=8,
+                   help="With --copy-method python (or where nothing faster "
+                        "works), megabytes to read and write at a time, "
+                        "from 1 to 1024. Default - 8.")
     p.add_argument('-c','--casesensitive', dest='casesensitive',
                    action='store_true', default=False,
                    help="For use on case sensitive filesystems Default - off.")
+    p.add_argument('--copy-method', dest='copy_method', metavar='METHOD',
+                   choices=('auto',) + CopyEngine.METHODS, default='auto',
+                   help="How to copy files to another device - reflink, "
+                        "copy_file_range, sendfile, python or auto (the "
+                        "first of these which works). Default - auto.")
+    p.add_argument('--copy-threads', dest='copy_threads', metavar='N',
+                   type=int, default=4,
+                   help="Number of files to copy at once when merging into "
+                        "an archive on another device. Default - 4.")
     p.add_argument('-d','--dorename', dest='dorename',
                    action='store_true', default=False,
                    help="Actually rename the files - otherwise just log "
                         "and output to standard output.")
+    p.add_argument('--daemon', dest='daemon', action='store_true',
+                   default=False,
+                   help="Stay resident, processing projects as soon as they "
+                        "have arrived, instead of being run from cron.")
+    p.add_argument('--drain', dest='drain', action='store_true',
+                   default=False,
+                   help="Process every project waiting in To Archive, rather "
+                        "than just the first.")
+    p.add_argument('--fair-weight', dest='fair_weight', metavar='N',
+                   type=int, default=3,
+                   help="With --schedule fair, the number of small projects "
+                        "to process for each large one. Default - 3.")
+    p.add_argument('--hash-algorithm', dest='hash_algorithm',
+                   metavar='NAME', type=hash_algorithm, default='md5',
+                   help="Hash used to compare files of the same size in the "
+                        "archive, e.g md5 or blake2b (faster, if this Python "
+                        "provides it). Default - md5.")
+    p.add_argument('--hash-cache', dest='hash_cache_file', metavar='PATH',
+                   help="Where to keep the hashes of archive files, so they "
+                        "needn't be hashed again. An empty string disables "
+                        "the cache. Default - hash_cache.db in logstash_dir.")
+    p.add_argument('--hash-threads', dest='hash_threads', metavar='N',
+                   type=int, default=4,
+                   help="Number of files to hash at once. Default - 4.")
     p.add_argument('-l','--logstash_dir', dest='logstash_dir', metavar="PATH",
                    help="A directory on the archive box containing a set of "
                         "files sent by rsyslog to logstash.")
+    p.add_argument('--reconcile-interval', dest='reconcile_interval',
+                   metavar='SECS', type=float, default=3600,
+                   help="With --archive-index and --daemon, how often to "
+                        "rescan the archive for changes made to it by other "
+                        "means. Default - 3600.")
     p.add_argument('-r','--rename_log_dir', dest='rename_log_dir',
                    metavar="PATH",
                    help="Directory, usually on the destination, for logs of "
                         "files which have been renamed to be stored.")
+    p.add_argument('--max-conflicts', dest='max_conflicts', metavar='N',
+                   type=int, default=0,
+                   help="Stop examining a project once N of its files are "
+                        "found to clash with the archive, rather than "
+                        "checking (and hashing) everything. Default - 0, "
+                        "check everything.")
     p.add_argument('-o','--oversizelog', dest='oversizelog', metavar="PATH",
                    help="Log to write files with overlong path names in - "
                         "otherwise don't log.")
     p.add_argument('-p','--passdir', dest='passdir', metavar="PATH",
                    help="Directory to which clean files should be moved.")
+    p.add_argument('--poll-interval', dest='poll_interval', metavar='SECS',
+                   type=float, default=60,
+                   help="With --daemon, the longest time to wait between "
+                        "checks of To Archive. Default - 60.")
     p.add_argument('-q','--quiet', dest='quiet', action='store_true',
                    default=False,
                    help="Don't output to standard out")
+    p.add_argument('--sanitise-cache-size', dest='sanitise_cache_size',
+                   metavar='N', type=int, default=10000,
+                   help="Number of sanitised names to cache. 0 disables the "
+                        "cache. Default - 10000.")
+    p.add_argument('--stat-threads', dest='stat_threads', metavar='N',
+                   type=int, default=8,
+                   help="Number of archive files to look up at once when "
+                        "merging into an existing folder. Default - 8.")
     p.add_argument('-t','--target', dest='target', metavar='PATH',
                    help="The location of the hot folder.")
+    p.add_argument('--schedule', dest='schedule', metavar='POLICY',
+                   choices=ProjectScheduler.POLICIES, default='name',
+                   help="Order in which to process projects - name, fifo "
+                        "(oldest first), shortest (smallest first) or fair "
+                        "(small projects alongside large). Default - name.")
+    p.add_argument('--settle-window', dest='settle_window', metavar='SECS',
+                   type=float, default=30,
+                   help="How long a project must go unchanged before it is "
+                        "considered fully uploaded. Default - 30.")
     p.add_argument('--temp-log-file', dest='temp_log_file', metavar='PATH',
                    default="/tmp/saniTempLog.log",
                    help="A file to write temporary log information to.")
     p.add_argument('--trust-source', dest='trust_source', action='store_true',
                    default=False, help="Transfer all files from source "
                                        "regardless of mod time. Use with caution.")
+    p.add_argument('--verify', dest='verify', action='store_true',
+                   default=False,
+                   help="Hash files as they are copied to another device, "
+                        "and only remove the originals once their copies, "
+                        "read back, match.")
+    p.add_argument('-w','--workers', dest='workers', metavar='N', type=int,
+                   default=1,
+                   help="With --drain, the number of projects to process at "
+                        "once. Default - 1.")
     #TODO: What does this store?
-    return p.parse_args()
+    args = p.parse_args()
+    if args.dorename and not args.rename_log_dir:
+        p.error("--dorename needs a directory to log renamed files to "
+                "(-r, usually on dest.)")
+    return args
+
+TRANSFER_JOURNAL_PREFIX = '.transfer-'
 
 class Sanitisation:
     """This is the parent object, containing variables for the sanitisation,
@@ -228,7 +2319,14 @@ class Sanitisation:
                  temp_log_file="/tmp/saniTempLog.log",
                  target='.', file_patterns_to_delete=['\.DS_Store', '\._*'],
                  test_suite=False, create_pid=True,
-                 trust_source=True):
+                 trust_source=True, sanitise_cache_size=10000,
+                 drain=False, workers=1, daemon=False, poll_interval=60,
+                 settle_window=30, schedule='name', fair_weight=3,
+                 stat_threads=8, archive_index=None,
+                 reconcile_interval=3600, hash_algorithm='md5',
+                 hash_threads=4, hash_cache_file=None, max_conflicts=0,
+                 copy_threads=4, copy_method='auto', block_size=8,
+                 verify=False):
 
         self.target = target
 
@@ -237,6 +2335,10 @@ class Sanitisation:
                 'log': os.path.join(self.target, "Logs"),
                 'problem': os.path.join(self.target, "Problem Files"),
                 'hidden': os.path.join(self.target, ".Hidden"),
+                # Per-worker staging folders, used in place of .Hidden when
+                # several projects are processed at once (see drain_queue).
+                # Kept out of .Hidden, where a project could share a name.
+                'staging': os.path.join(self.target, ".Staging"),
                 'pass': os.path.join(self.target, "Passed_For_Archive"), # TODO: Really?
                  }
 
@@ -258,24 +2360,59 @@ class Sanitisation:
         # Attributes with set initial values
         self.error_list = []
         self.errors_found = False
-        self.l_case_list = [] #See Sanitise
+        self.case_index = PathIndex(fold_case=True) #See rename_to_clean
         self.log_files = []
+        self.log_folder = None
         self.old_path = ''
-        self.sanitised_list = []
+        #Clean paths suggested in dry runs
+        self.sanitised_index = PathIndex(fold_case=not case_sens)
+        #Listings used to allocate '(n)'s
+        self.dir_cache = DirectoryCache(fold_case=not case_sens)
         self.no_of_retries = 3
+        self.sanitise_cache = SanitiseCache(sanitise_cache_size)
 
         self.hidden_dir = dirs['hidden']
+        self.staging_dir = dirs['staging']
+        self.staging_slot = None # See use_staging_slot
         self.illegal_log_dir = dirs['log'] #TODO: Really?
         self.problem_dir = dirs['problem']
         self.to_archive_dir = dirs['to_archive']
         self.transfer_error_dir = os.path.join(self.problem_dir,
                                                "_Transfer_Errors")
+        self.rename_plan_dir = os.path.join(self.illegal_log_dir,
+                                            ".rename_plans")
         self.file_patterns_to_delete = file_patterns_to_delete
+        self.delete_matcher = DeleteMatcher(file_patterns_to_delete)
 
         # Switches
         self.case_sens = case_sens
         self.quiet = quiet
         self.rename = rename
+        self.drain = drain # Process every queued project, not just one
+        self.workers = workers # Number of projects to process at once
+        self.stat_threads = stat_threads # Concurrent stats of archive files
+        if archive_index: # Catalogue of pass_dir
+            archive_index = ArchiveIndex(os.path.abspath(archive_index),
+                                         os.path.abspath(pass_dir))
+        self.archive_index = archive_index
+        self.reconcile_interval = reconcile_interval
+        hash_cache = None
+        if hash_cache_file is None:
+            hash_cache_file = os.path.join(self.logstash_dir, "hash_cache.db")
+        if hash_cache_file and sqlite3 is not None:
+            hash_cache = HashCache(os.path.abspath(hash_cache_file))
+        self.hasher = ContentHasher(hash_algorithm, hash_threads,
+                                    cache=hash_cache)
+        self.max_conflicts = max_conflicts # Stop merging after this many
+        self.copy_threads = copy_threads # Files to copy at once
+        self.copy_engine = CopyEngine(copy_method, block_size * 1024 ** 2,
+                                      verify=hash_algorithm if verify else None)
+        self.daemon = daemon # Stay resident, rather than run once
+        self.poll_interval = poll_interval # Longest wait between daemon checks
+        self.quiescence = QuiescenceMonitor(settle_window)
+        self.scheduler = ProjectScheduler(
+            schedule, self.quiescence, fair_weight,
+            os.path.join(self.illegal_log_dir, ".schedule.txt"))
         self.test_suite = test_suite
         self.trust_source = trust_source
 
@@ -330,7 +2467,8 @@ class Sanitisation:
             else:
                 raise
 
-    def rename_to_clean(self, obj, path, obj_type, rename_log_file):
+    def rename_to_clean(self, obj, path, obj_type, rename_log_file=None,
+                        plan=None):
         """If path contains any forbidden characters, sanitise it and rename it.
 
         obj : str
@@ -341,14 +2479,17 @@ class Sanitisation:
             The type of the object to be sanitised ('file' or 'dir')
         rename_log_file : str : path
             Path to the file in which to log renamed objects.
+        plan : RenamePlan
+            If given, record the rename in plan rather than making it.
 
         """
         full_path = os.path.join(path, obj)
         clean_path = full_path
-        clean_dict = sanitise(obj)
+        clean_dict = self.sanitise_cache.sanitise(obj)
 
-        #If sanitising made any difference, there will be entries in subMade
-        if clean_dict['subs_made']:
+        #If sanitising made any difference, the output will differ. (Checking
+        #this rather than subs_made saves working out the details.)
+        if clean_dict['out_string'] != obj:
             #Check for strings prefixed with '.', remove this character, and replace it after file renaming.
             self.errors_found = True
             prefix = ""
@@ -367,33 +2508,36 @@ class Sanitisation:
             clean_dict['out_string'] = prefix + clean_dict['out_string']
             clean_path = os.path.join(path, clean_dict['out_string'])
             #If the clean path already exists, append '(n)' to the filename
-            if os.path.exists(clean_path) or \
-            clean_path in self.sanitised_list:
-                clean_path = swisspy.append_index(clean_split[0],
-                                                  clean_dict['out_string'][len(clean_split[0]):],
-                                                  path)
+            if self.dir_cache.exists(clean_path) or \
+            clean_path in self.sanitised_index:
+                clean_path = self.dir_cache.append_index(clean_split[0],
+                                                         clean_dict['out_string'][len(clean_split[0]):],
+                                                         path,
+                                                         taken=self.sanitised_index)
             #Set the newly constructed path as the clean path to use
             clean_dict['out_string'] = os.path.basename(clean_path)
-            self.rename_file(clean_dict, full_path, rename_log_file,
-                             self.rename)
+            self._rename_or_plan(clean_dict, full_path, obj_type,
+                                 rename_log_file, plan)
         # If the cleaned and original versions are the same, check that there's no
         # case clash with a previously seen file
         else:
             if self.case_sens:
                 extension = ""
-                if full_path.lower() in self.l_case_list:
+                if full_path in self.case_index:
                     filename = full_path.split('/')[-1]
                     if "." in filename:
                         extension = "." + filename.split(".")[-1]
                         filename = filename[:-len(extension)]
-                    clean_path = swisspy.append_index(filename, extension, path)
-                    self.rename_file(clean_dict, full_path,
-                                     rename_log_file, self.rename)
+                    clean_path = self.dir_cache.append_index(filename, extension,
+                                                             path)
+                    clean_dict['out_string'] = os.path.basename(clean_path)
+                    self._rename_or_plan(clean_dict, full_path, obj_type,
+                                         rename_log_file, plan)
 
         # Append the clean (i.e final) path to the array which will allow us to
         # check for case sensitive clashes, if the case sensitive option is set.
         if self.case_sens:
-            self.l_case_list.append(clean_path.lower())
+            self.case_index.add(clean_path)
         if self.oversize_log_file_name is not None:
             if len(full_path) > 254:
                 log_to = self.log_files
@@ -403,7 +2547,169 @@ class Sanitisation:
                                                                    str(len(clean_path))),
                                       [log_to], quiet=self.quiet)
 
-    def move_and_merge(self, source, dest, retry=3):
+    def _rename_or_plan(self, clean_dict, full_path, obj_type,
+                        rename_log_file, plan):
+        """Rename full_path as rename_to_clean() has decided, or if a plan is
+        being made, add it to the plan and mark the new name as taken."""
+        if plan is None:
+            self.rename_file(clean_dict, full_path, rename_log_file,
+                             self.rename)
+        else:
+            self.sanitised_index.add(os.path.join(os.path.dirname(full_path),
+                                                  clean_dict['out_string']))
+            plan.add(full_path, clean_dict['out_string'], obj_type)
+
+    def plan_renames(self, tree, deleted_files=None):
+        """Go through tree once, returning a RenamePlan of every rename needed
+        to sanitise it, with all collisions between new names resolved.
+        Nothing is renamed, but unwanted files (see remove_unwanted_files)
+        are deleted along the way, before the plan's digest of the tree is
+        taken.
+
+        tree : ScannedTree
+            A scan of the project directory to be sanitised
+        deleted_files : list
+            If given, the names of any deleted files are appended to this.
+
+        """
+        plan = RenamePlan(tree.root)
+        if deleted_files is None:
+            deleted_files = []
+        for path, dirs, files in tree.walk(topdown=False):
+            #Delete unwanted files, then sanitise the names of the rest
+            files = self.remove_unwanted_files(path, files, deleted_files,
+                                               tree)
+            for f in self.names_to_check(files):
+                self.rename_to_clean(f, path, 'file', plan=plan)
+            #Sanitise directory names
+            for d in self.names_to_check(dirs):
+                self.rename_to_clean(d, path, 'dir', plan=plan)
+        plan.digest = RenamePlan.tree_digest(tree)
+        return plan
+
+    def apply_rename_plan(self, plan, rename_log_file, tree=None,
+                          journal=None):
+        """Carry out (or, if self.rename isn't set, report) the renames in
+        plan, deepest first, skipping any already applied.
+
+        plan : RenamePlan
+            As returned by plan_renames() or RenamePlan.load()
+        rename_log_file : str : path
+            Path to the file in which to log renamed objects.
+        tree : ScannedTree
+            If given, a scan of plan.root to be kept up to date with the
+            renames made.
+        journal : TransferJournal
+            If given, each rename made is recorded in it as it is made, so
+            that an interrupted run can carry on where it left off.
+
+        """
+        for rel_path, new_name, obj_type in plan.in_apply_order():
+            if rel_path in plan.applied:
+                continue
+            prev_path = os.path.join(plan.root, rel_path)
+            #Only the details of the original name are needed here
+            clean_dict = self.sanitise_cache.sanitise(
+                os.path.basename(prev_path))
+            clean_dict['out_string'] = new_name
+            renamed = self.rename_file(clean_dict, prev_path,
+                                       rename_log_file, self.rename)
+            if renamed and journal is not None:
+                journal.write('renamed', rel_path)
+            if tree is not None and renamed:
+                tree.rename(rel_path, new_name)
+
+    def rename_plan_file(self, extension='.txt'):
+        """Path to which this project's rename plan is saved - by a dry run,
+        or while a --dorename run applies it - or, with extension
+        '.journal', that of the journal of the renames applied. These are
+        kept in a hidden folder within Logs, out of the way of the project's
+        log files."""
+        try:
+            os.mkdir(self.rename_plan_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return os.path.join(self.rename_plan_dir,
+                            os.path.basename(self.log_folder) + extension)
+
+    def load_rename_plan(self, target_path, tree):
+        """Return the rename plan saved by a previous dry run of this project,
+        if there is one and it still applies to target_path (of which tree
+        is a fresh scan); else None, so that the project is planned again -
+        deleting unwanted files, and checking new names for collisions."""
+        plan_file = self.rename_plan_file()
+        if not os.path.exists(plan_file):
+            return None
+        try:
+            plan = RenamePlan.load(plan_file, target_path,
+                                   self.rename_plan_file('.journal'))
+        except (IOError, SyntaxError, ValueError) as e:
+            swisspy.print_and_log("Unable to read saved rename plan {0}: {1}"
+                                  "\n".format(plan_file, e),
+                                  self.log_files, quiet=self.quiet)
+            return None
+        if not plan.is_applicable(tree):
+            swisspy.print_and_log("The saved rename plan no longer matches "
+                                  "the project. Rescanning.\n",
+                                  self.log_files, quiet=self.quiet)
+            return None
+        return plan
+
+    def remove_unwanted_files(self, path, files, deleted_files, tree=None):
+        """Delete any of files (in path) which match file_patterns_to_delete
+        (see DeleteMatcher). Returns the names of the files left.
+
+        deleted_files : list
+            The names of any deleted files are appended to this.
+        tree : ScannedTree
+            If given, a scan containing path to be kept up to date.
+
+        """
+        remaining = []
+        for f in files:
+            if not self.delete_matcher.matches(f):
+                remaining.append(f)
+                continue
+            full_path = os.path.join(path,f)
+            try:
+                os.remove(full_path)
+                self.dir_cache.discard(full_path)
+                if tree is not None:
+                    tree.remove(full_path[len(tree.root) + 1:])
+                deleted_files.append(f)
+            except Exception as e:
+                remaining.append(f)
+                msg = "Unable to remove file {0} \n " \
+                      "Error details: {1}\n".format(f, str(e))
+                swisspy.print_and_log(msg, self.log_files,
+                                      quiet=self.quiet)
+        return remaining
+
+    def names_to_check(self, names):
+        """Return those of names which rename_to_clean() has any work to do on.
+
+        Unless the case sensitive or oversize checks need to see every name,
+        this is just the names which sanitising would change, found for the
+        whole listing at once with sanitise_many().
+
+        names : list : str
+            A directory listing, as returned by os.walk
+
+        """
+        if self.case_sens or self.oversize_log_file_name is not None:
+            return names
+        changed = sanitise_many(names, self.sanitise_cache.sanitise)[1]
+        return [n for n, c in zip(names, changed) if c]
+
+    def reset_project_indexes(self):
+        """Forget the names recorded while sanitising a project, so that
+        nothing is carried over into (or kept in memory after) the next."""
+        self.case_index.clear()
+        self.sanitised_index.clear()
+        self.dir_cache.clear()
+
+    def move_and_merge(self, source, dest, retry=3, source_tree=None):
         """Copy source to dest, merging child folders which already exist in dest,
         but erroring on any files which already exist there.
 
@@ -413,14 +2719,20 @@ class Sanitisation:
             The destination
         retry : int
             How many times to retry failed transfers
+        source_tree : ScannedTree
+            A scan of source, if one has already been made.
 
         """
+        if source_tree is None:
+            source_tree = ScannedTree(source)
         existing_differing_files = [] #Files which already exist in dest, and differ from any uploaded files with the same name. If this is not empty by the end of the walk, source will not be copied
         different_but_trusted = []
         existing_same_files = [] #Files which exist in the destination but have the same modification time and size as the file to be moved.
         cleared_for_copy = [] # Array of directories which can safely be copied as long as no clashes are found. Returned if and only if existing_differing_files is empty.
         copied_files = [] # Array of files which made it.
         empty_dirs = []
+        to_hash = [] # (source, dest) Files whose contents must be compared
+        journal = None # The TransferJournal, if the transfer is journaled
 
         #TODO: Put the variables above into the docstring
         source_to_log = source.split('/')[-1]
@@ -435,7 +2747,7 @@ class Sanitisation:
                     self.started_transfer.set()
                 # Try and move things, abort on error.
                 try:
-                    shutil.move(source, dest)
+                    journal = self.move_project(source, dest)
                 except Exception as e:
                     msg = "A fatal error occurred while transferring: " + \
                           str(e) + "\n"
@@ -447,6 +2759,9 @@ class Sanitisation:
 
                     swisspy.print_and_log(msg, self.log_files,
                                           quiet=self.quiet)
+                    copied_files = source_tree.file_paths(under=dest)
+                    self.index_archive(source_tree, dest)
+                    self.log_copy_report()
             except shutil.Error as e:
                 self.error_list.append(e)
                 msg = "One or more files failed while trying to move {0} " \
@@ -454,17 +2769,27 @@ class Sanitisation:
                       "Error:\n {3}".format(source_to_log, dest,
                                            self.problem_dir, e)
                 swisspy.print_and_log(msg, self.log_files, quiet=self.quiet)
-            #Walk to get list of files moved
-            for root, dirs, files in os.walk(dest):
-                for f in files:
-                     copied_files.append(os.path.join(root,f))
+            #If the move failed, walk to get list of files moved
+            if not copied_files:
+                for root, dirs, files in os.walk(dest):
+                    for f in files:
+                         copied_files.append(os.path.join(root,f))
 
         # Otherwise, move the data and merge it with the existing stuff in dest.
         else:
             swisspy.print_and_log("Examining " + dest +
                                   " for existing files\n",
                                   self.log_files, quiet=self.quiet)
-            for root, dirs, files in os.walk(source):
+            # List only the part of dest which source overlaps. Files there
+            # are stat'ed only if they turn out to clash.
+            # With max_conflicts set, stop at that many blocking conflicts,
+            # stat'ing archive files a directory at a time as the walk
+            # reaches them, and only hashing if nothing else blocks.
+            fail_fast = self.max_conflicts > 0
+            stopped_early = False
+            dest_tree = self.archived_tree(dest, source_tree,
+                                           stat_clashes=not fail_fast)
+            for root, dirs, files in source_tree.walk():
 
                 # These are threading events used when testing transfers - in
                 # this case to modify the file after it's been scanned and set
@@ -474,21 +2799,33 @@ class Sanitisation:
                 if self.pause_after_scan:
                     self.pause_after_scan.wait(10)
 
+                if fail_fast:
+                    rel_root = root[len(source)+1:]
+                    dest_tree.stat_many([os.path.join(rel_root, f)
+                                         for f in files if dest_tree.exists(
+                                             os.path.join(rel_root, f))],
+                                        threads=self.stat_threads)
+
                 #Starting from the deepest file..
                 for f in files:
+                    if fail_fast and \
+                       len(existing_differing_files) >= self.max_conflicts:
+                        stopped_early = True
+                        break
                     source_file = File(path=os.path.join(root,f))
                     path_after_source = source_file.path[len(source)+1:]
-                    dest_file = File(path=os.path.join(dest, path_after_source))
+                    dest_file = File(path=os.path.join(
+                        dest, dest_tree.match(path_after_source)))
                     #If any file in source exists in dest, log this.
                     #Otherwise, add it to the 'cleared' list.
-                    if os.path.exists(dest_file.path):
+                    if dest_tree.exists(path_after_source):
                         #Get attributes for source and dest files
-                        source_file.size = os.path.getsize(source_file.path)
-                        source_file.m_time_secs = os.path.getmtime(source_file.path)
+                        source_file.size, source_file.m_time_secs = \
+                            source_tree.stat(path_after_source)
                         source_file.modification_time = ctime(source_file.m_time_secs)
 
-                        dest_file.size = os.path.getsize(dest_file.path)
-                        dest_file.m_time_secs = os.path.getmtime(dest_file.path)
+                        dest_file.size, dest_file.m_time_secs = \
+                            dest_tree.stat(path_after_source)
                         dest_file.modification_time = ctime(dest_file.m_time_secs)
 
                         # If size and mod time are the same, so are the files.
@@ -496,48 +2833,76 @@ class Sanitisation:
                         if source_file.size == dest_file.size and \
                            str(source_file.m_time_secs) == str(dest_file.m_time_secs):
                             existing_same_files.append(source_file)
+                        elif source_file.size < dest_file.size:
+                            existing_differing_files.append((source_file,
+                                                             dest_file))
+
+                        # If the sizes are the same, but m_time differs,
+                        # compare hashes - all at once, below. Skip if
+                        # trust_source is on.
+                        elif source_file.size == dest_file.size and \
+                             not self.trust_source:
+                            to_hash.append((source_file, dest_file))
+
+                        # If the source is larger, but 'trust source' is set,
+                        # overwrite the dest.
+                        # (This is somewhat of a hack).
+                        elif self.trust_source:
+                            different_but_trusted.append((source_file,
+                                                          dest_file))
+                            cleared_for_copy.append(source_file.path)
                         else:
-                            if source_file.size < dest_file.size:
-                                existing_differing_files.append((source_file,
-                                                                 dest_file))
-
-                            # If the source is larger, but 'trust source' is set,
-                            # overwrite the dest.
-                            # (This is somewhat of a hack).
-                            if source_file.size >= dest_file.size:
-                                if self.trust_source:
-                                    different_but_trusted.append((source_file,
-                                                                  dest_file))
-                                    cleared_for_copy.append(source_file.path)
-                                else:
-                                    existing_differing_files.append((source_file,
-                                                                     dest_file))
-
-                            # If the sizes are the same, but m_time differs,
-                            # do an md5 check. Skip if trust_source is on.
-                            elif not self.trust_source:
-                                if source_file.m_time_secs != dest_file.m_time_secs:
-                                    source_file.md5 = swisspy.get_md5(source_file.path)
-                                    dest_file.md5 = swisspy.get_md5(dest_file.path)
-                                    # If the md5s differ, so do the files
-                                    if source_file.md5 != dest_file.md5:
-                                        existing_differing_files.append((source_file,
-                                                                       dest_file))
-                                    else:
-                                        existing_same_files.append(source_file)
+                            existing_differing_files.append((source_file,
+                                                             dest_file))
                     else:
                         cleared_for_copy.append(source_file.path)
 
+                if stopped_early:
+                    break
+
                 # If the whole directory doesn't exist in the destination, just
                 # put it on the 'to copy' list without walking it.
-                for d in dirs:
+                for d in dirs[:]:
                     dir = os.path.join(root,d)
                     after_source = dir[len(source)+1:]
-                    if not os.path.exists(os.path.join(dest, after_source)):
+                    if not dest_tree.exists(after_source):
                         cleared_for_copy.append(dir)
                         #Remove this directory from the list of dirs to be walked
                         dirs.remove(d)
 
+            # Hash both copies of each file whose size matches but whose
+            # modification time doesn't. If the hashes differ, so do the files
+            if fail_fast and (stopped_early or existing_differing_files):
+                stopped_early = stopped_early or bool(to_hash)
+                to_hash = []
+            # In fail fast mode, hash a batch at a time, stopping when
+            # there are enough conflicts.
+            batch_size = self.hasher.threads if fail_fast else len(to_hash)
+            for i in range(0, len(to_hash), batch_size or 1):
+                batch = to_hash[i:i + batch_size]
+                if fail_fast and \
+                   len(existing_differing_files) >= self.max_conflicts:
+                    stopped_early = True
+                    break
+                hashes = self.hasher.hash_files([f.path for pair in batch
+                                                 for f in pair])
+                for pair in batch:
+                    for f in pair:
+                        f.hash = hashes.get(f.path)
+                        f.hash_algorithm = self.hasher.algorithm
+                    source_file, dest_file = pair
+                    if source_file.hash is None or \
+                       source_file.hash != dest_file.hash:
+                        existing_differing_files.append(pair)
+                    else:
+                        existing_same_files.append(source_file)
+            cache = self.hasher.cache
+            if cache is not None and cache.hits + cache.misses:
+                swisspy.print_and_log("Hash cache: {0} hits, {1} misses."
+                                      "\n".format(cache.hits, cache.misses),
+                                      self.log_files, quiet=self.quiet)
+                cache.reset_counts()
+
             # If there are files attempting transfer which exist on the archive,
             # and which shouldn't be overwritten, log this and fail the transfer.
             if existing_differing_files:
@@ -549,18 +2914,16 @@ class Sanitisation:
                     file_no += 1
                     #edf is a tuple of source and dest files, so:
                     for f in edf:
-                        file_report = "\n\t{0}:".format(f.path)
-                        for attr_name in ['size','modification_time','md5']:
-                            attr_value = getattr(f,attr_name)
-                            if attr_value:
-                                file_report += "\n\t{0}: {1}".format(attr_name,
-                                                                     attr_value)
-                        file_reports.append(file_report)
+                        file_reports.append(f.report())
                     file_reports.append("\n")
 
                 message = "The following {0} files already exist in {1}; " \
                           "the transfer was unable to continue." \
                           "\n".format(len(existing_differing_files), dest)
+                if stopped_early:
+                    message += "Examination stopped after {0} conflicts; " \
+                               "the rest of the project was not checked." \
+                               "\n".format(len(existing_differing_files))
 
                 log_list(message, file_reports, log_files = self.log_files)
                         #TODO: Put syslog files in here, into [there_and_different]
@@ -579,13 +2942,7 @@ class Sanitisation:
                         file_reports.append(header)
                         file_no += 1
                         for f in dbt:
-                            file_report = "\n\t{0}:".format(f.path)
-                            for attr_name in ['size','modification_time','md5']:
-                                attr_value = getattr(f,attr_name)
-                                if attr_value:
-                                    file_report += "\n\t{0}: {1}".format(attr_name,
-                                                                         attr_value)
-                            file_reports.append(file_report)
+                            file_reports.append(f.report())
                         file_reports.append("\n")
 
                     message = "The following {0} files already exist in {1}, but " \
@@ -594,20 +2951,46 @@ class Sanitisation:
                     log_list(message, file_reports, log_files = self.log_files)
 
                 if cleared_for_copy:
+                    journal = self.start_journal(
+                        source, dest, [f.path for f in existing_same_files])
                     try:
                         copied_files.extend(self.move_files(source, dest,
-                                                            cleared_for_copy))
+                                                            cleared_for_copy,
+                                                            journal,
+                                                            dest_tree))
                     except Exception as e:
                         msg = "A fatal error occurred while transferring: " +\
                               str(e) + "\n"
                         swisspy.print_and_log(msg, self.log_files,
                                               quiet=self.quiet)
+                        self.end_journal(journal)
                         raise
 
                     else:
                         swisspy.print_and_log("No transfer errors occurred. " +\
                                               "Folder exists at " + dest + "\n\t",
                                               self.log_files, quiet=self.quiet)
+                if self.archive_rel_path(dest) is not None:
+                    # Record the merged folder: the archive's own entries
+                    # where its copy was kept, the project's everywhere else.
+                    # Paths are named as the archive names them, where it
+                    # has them in another case.
+                    kept = set([dest_tree.match(f.path[len(source)+1:])
+                                for f in existing_same_files])
+                    merged = {}
+                    for e in source_tree.entries():
+                        rel_path = dest_tree.match(e[0])
+                        if rel_path not in kept:
+                            merged[rel_path] = (rel_path,) + e[1:]
+                    source_dirs = set([dest_tree._fold(d)
+                                       for d in source_tree.listing])
+                    overlap = [d for d in dest_tree.listing
+                               if dest_tree._fold(d) in source_dirs]
+                    for e in dest_tree.entries(overlap):
+                        if e[0] in kept or e[0] not in merged:
+                            merged[e[0]] = e
+                    self.index_archive(
+                        ScannedTree.from_entries(dest, merged.values()), dest)
 
         if copied_files:
             log_list("The following files transferred successfully: \n\t",
@@ -632,19 +3015,205 @@ class Sanitisation:
                                               self.log_files,
                                               quiet=self.quiet)
 
-                # Walk the remaining files from the bottom,
-                # removing empty directories:
-                for root, dirs, files in os.walk(source,topdown=False):
-                    empty_dirs.append(root)
-                    os.rmdir(root)
+                # Go through the remaining directories from the bottom,
+                # removing them now they're empty. Those moved in their
+                # entirety will already have gone.
+                for rel_dir in source_tree.dirs_bottom_up():
+                    root = source_tree.abs_path(rel_dir)
+                    try:
+                        os.rmdir(root)
+                        empty_dirs.append(root)
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
                 swisspy.print_and_log("Removed the following "
                                       "empty directories:\n\t{0}\n"
                                       "".format('\n\t'.join(self.strip_hidden(empty_dirs,
                                                                               prefix))))
+        if journal is not None:
+            self.end_journal(journal)
+
+    def start_journal(self, source, dest, same_files=()):
+        """Begin the journal of source's transfer to dest. source is a
+        project staged in .Hidden, so the journal is kept beside it.
+
+        same_files : list : paths
+            Files in source already in the archive, to be removed once
+            everything else has been moved.
+        Returns the TransferJournal.
+
+        """
+        parent, folder = os.path.split(source.rstrip('/'))
+        journal = TransferJournal(TransferJournal.path_for(parent, folder))
+        if os.path.exists(journal.path):
+            os.remove(journal.path) # Left by an earlier transfer
+        journal.write('transfer', source, dest)
+        for path in same_files:
+            journal.write('same', path)
+        return journal
+
+    def end_journal(self, journal):
+        """Close and remove journal, once its transfer has finished or
+        failed, since there is nothing left to resume."""
+        journal.close()
+        try:
+            os.remove(journal.path)
+        except OSError:
+            pass
+
+    def move_project(self, source, dest):
+        """Move source, a whole project, to dest, which doesn't exist yet:
+        by renaming it if possible, and otherwise (if dest is on another
+        device) a file at a time with move_in_parallel(), journaled so that
+        the move can be resumed if the process is killed part way through.
+        Returns the TransferJournal, to be ended once the project has been
+        dealt with, or None if source was renamed.
+
+        """
+        try:
+            os.rename(source, dest)
+            return None
+        except OSError:
+            pass
+        journal = self.start_journal(source, dest)
+        moves = [(source, os.path.basename(source), dest)]
+        journal.write('item', *moves[0])
+        try:
+            self.move_in_parallel(moves, journal)
+        except Exception:
+            self.end_journal(journal)
+            raise
+        return journal
+
+    def resume_transfer(self, journal):
+        """Finish the transfer recorded in journal, which was interrupted:
+        move whatever it hadn't yet, then tidy up as move_and_merge() does.
+        Raises the error if the transfer fails again.
+
+        journal : TransferJournal
+
+        """
+        entries = journal.read()
+        source, dest = entries[0][1:]
+        done = set([e[1] for e in entries if e[0] == 'done'])
+        items = [e[1:] for e in entries if e[0] == 'item']
+        moves = [i for i in items if i[0] not in done and
+                 os.path.lexists(i[0])]
+        swisspy.print_and_log("Resuming the interrupted transfer of {0} to "
+                              "{1}: {2} of {3} items left to move.\n"
+                              "".format(source, dest, len(moves), len(items)),
+                              self.log_files, quiet=self.quiet)
+        try:
+            copied_files = self.move_in_parallel(moves, journal, resume=True)
+        except Exception as e:
+            swisspy.print_and_log("A fatal error occurred while transferring: "
+                                  "{0}\n".format(e), self.log_files,
+                                  quiet=self.quiet)
+            self.end_journal(journal)
+            raise
+        log_list("Files transferred: ", copied_files,
+                 log_files=self.log_files,
+                 syslog_files=[self.logstash_files['transferred']])
+        self.log_copy_report()
+        for e in entries:
+            if e[0] == 'same' and os.path.lexists(e[1]):
+                os.remove(e[1])
+        for root, dirs, files in os.walk(source, topdown=False):
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass # Not empty; left for purge_hidden_dir
+        self.end_journal(journal)
+
+    def archive_rel_path(self, path):
+        """Return path relative to the archive index's root, or None if
+        there is no index or path isn't within it."""
+        if self.archive_index is None:
+            return None
+        root = os.path.join(self.archive_index.root, '')
+        if not path.startswith(root) or path == root:
+            return None
+        return path[len(root):].rstrip('/')
+
+    def archived_tree(self, dest, source_tree, stat_clashes=True):
+        """Return a ScannedTree of the part of dest which source_tree will be
+        merged into, with the files which clash stat'ed unless stat_clashes
+        is False. Comes from the archive index if it has an up-to-date
+        record of dest, and otherwise from a scan (which is then recorded).
+
+        A file rewritten in place doesn't change its directory, so may have
+        been catalogued before it was; the catalogue's sizes and times are
+        never used for the files which clash, which are stat'ed afresh.
+
+        """
+        rel_dest = self.archive_rel_path(dest)
+        if rel_dest is not None:
+            dest_tree = self.archive_index.tree(rel_dest, within=source_tree,
+                                                threads=self.stat_threads,
+                                                fold_case=not self.case_sens)
+            if dest_tree is not None:
+                clashes = [dest_tree.match(r) for r in source_tree.file_stats
+                           if dest_tree.exists(r)]
+                for rel_path in clashes:
+                    dest_tree.file_stats.pop(rel_path, None)
+                if stat_clashes:
+                    dest_tree.stat_many(clashes, threads=self.stat_threads)
+                return dest_tree
+        scanned_at = time.time()
+        dest_tree = ScannedTree(dest, with_stats=False, within=source_tree,
+                                fold_case=not self.case_sens)
+        if rel_dest is not None:
+            dest_tree.stat_many([os.path.join(d, f)
+                                 for d in dest_tree.listing
+                                 for f in dest_tree.listing[d][1]],
+                                threads=self.stat_threads)
+            self.archive_index.record_tree(dest_tree, rel_dest,
+                                           self.stat_threads, scanned_at)
+        elif stat_clashes:
+            dest_tree.stat_many([r for r in source_tree.file_stats
+                                 if dest_tree.exists(r)],
+                                threads=self.stat_threads)
+        return dest_tree
+
+    def index_archive(self, tree, dest):
+        """Record tree, which has just been moved to dest, in the archive
+        index (if there is one, and dest is within it)."""
+        rel_dest = self.archive_rel_path(dest)
+        if rel_dest is None:
+            return
+        try:
+            self.archive_index.record_tree(tree, rel_dest, self.stat_threads)
+        except Exception as e:
+            # The index is only an optimisation; the next scan will fix it
+            self.archive_index.forget(rel_dest)
+            swisspy.print_and_log("Couldn't update the archive index: "
+                                  "{0}\n".format(e), self.log_files,
+                                  quiet=self.quiet)
+
+    def purge_hidden_dir(self, hidden_dir=None):
+        """Move all files back out of .Hidden and into self.problem_dir,
+        but not projects with a transfer in progress.
+
+        hidden_dir : str : path
+            Default: self.hidden_dir, and (unless this is a worker, with a
+            staging slot of its own) any worker staging slots.
+            The staging folder to empty.
 
-    def purge_hidden_dir(self):
-        """Move all files back out of .Hidden and into self.problem_dir"""
-        for o in swisspy.immediate_subdirs(self.hidden_dir):
+        """
+        if hidden_dir is None:
+            hidden_dir = self.hidden_dir
+            if self.staging_slot is None:
+                for slot_dir in self.staging_slot_dirs():
+                    self.purge_hidden_dir(slot_dir)
+        for o in swisspy.immediate_subdirs(hidden_dir):
+            # Leave projects whose transfer was interrupted where they are,
+            # to be resumed (see resume_transfers()).
+            journal = TransferJournal(TransferJournal.path_for(hidden_dir, o))
+            if journal.in_progress():
+                swisspy.print_and_log("Leaving {0} in {1} to resume its "
+                                      "transfer.\n".format(o, hidden_dir),
+                                      self.log_files, quiet=self.quiet)
+                continue
             # If any file in .Hidden is already in problemFolder,
             # move it to a new timestamped folder to avoid overwriting.
             if os.path.exists(os.path.join(self.problem_dir, o)):
@@ -659,12 +3228,39 @@ class Sanitisation:
             else:
                 moved_to = self.problem_dir
             try:
-                shutil.move(os.path.join(self.hidden_dir, o), moved_to)
+                shutil.move(os.path.join(hidden_dir, o), moved_to)
             except OSError as e:
                 msg = "The following error occurred when moving {0}/{1}:" \
-                      "{2}".format(self.hidden_dir, o, e)
+                      "{2}".format(hidden_dir, o, e)
                 swisspy.print_and_log(msg, self.log_files, quiet=self.quiet)
 
+    def use_staging_slot(self, slot):
+        """Stage projects in a folder of their own within self.staging_dir,
+        rather than in .Hidden, so that this (worker) process can run
+        alongside others. Also stops this process from touching the pid
+        file.
+
+        slot : int
+            Number of the slot, unique among the running workers
+
+        """
+        self.staging_slot = slot
+        self.hidden_dir = os.path.join(self.staging_dir, str(slot))
+        self.the_root = self.hidden_dir
+        self.create_pid = False
+        try:
+            os.makedirs(self.hidden_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST: # Left by an earlier run
+                raise
+
+    def staging_slot_dirs(self):
+        """Return the paths of any worker staging slots which exist"""
+        if not os.path.isdir(self.staging_dir):
+            return []
+        return [os.path.join(self.staging_dir, d)
+                for d in swisspy.immediate_subdirs(self.staging_dir)]
+
     def rename_file(self, path_dict, prev_path, rename_log_file,
                     rename=False, indicator='^',):
         """Renames a file, or logs its abberations
@@ -681,28 +3277,20 @@ class Sanitisation:
         indicator : str
             Used in logging to indicate positions of changed characters
 
+        Returns the new path if the file was renamed, otherwise None.
+
         """
         prev_root = os.path.dirname(prev_path)
         new_path = os.path.join(prev_root, path_dict['out_string'])
-        #Work out where the changed characters are in the full string, as opposed
-        #to just the basename. Strip the path the the hidden dir off this.
-        positions_in_path = [p + len(prev_root) - len(self.hidden_dir) for p in path_dict['positions']]
         #Strip the path of the hidden dir out of the string to be logged
         #The '+1' here deals with the first forward slash
         path_to_log = prev_path[len(self.hidden_dir) + 1:]
         new_path_to_log = new_path[len(self.hidden_dir) + 1:]
-        #Construct indicator string (shows where offending characters are)
-        ind_list = []
-        for i in range(len(path_to_log)):
-            if i in positions_in_path:
-                ind_list.append(indicator)
-            else:
-                ind_list.append(" ")
-        ind_line = ''.join(ind_list)
 
         if rename:
             try:
                 shutil.move(prev_path, new_path)
+                self.dir_cache.rename(prev_path, new_path)
                 # Log the renamed file in human readable format, on the
                 # SAN if a rename log file has been defined...
                 change_log_files = self.log_files[:]
@@ -718,14 +3306,24 @@ class Sanitisation:
                     with open(self.logstash_files['renamed'], 'a') as lsf:
                         lsf.write("{Changed from: }" + prev_path +\
                                   "{to: }" + new_path + '\n')
+                return new_path
             except OSError:
                 swisspy.print_and_log("Error: unable to rename " + prev_path + '\n',
                                    self.log_files, ts="long", quiet=self.quiet)
         else:
             # Add the clean path to a list of changed files,
             # so that logging without changing works correctly
-            self.sanitised_list.append(new_path)
+            self.sanitised_index.add(new_path)
             if path_dict['subs_made']:
+                #Work out where the changed characters are in the full string,
+                #as opposed to just the basename. Strip the path the the hidden
+                #dir off this. This is only needed for the report, so isn't
+                #done (nor are the positions worked out) when renaming.
+                positions_in_path = set([p + len(prev_root) - len(self.hidden_dir)
+                                         for p in path_dict['positions']])
+                #Construct indicator string (shows where offending characters are)
+                ind_line = ''.join([indicator if i in positions_in_path else " "
+                                    for i in range(len(path_to_log))])
                 swisspy.print_and_log("Illegal characters found in file   : " +\
                                    path_to_log + '\n',
                                    self.log_files, ts=None, quiet=self.quiet)
@@ -781,12 +3379,25 @@ class Sanitisation:
             pf = open(self.pid_file, 'w')
             pf.write(str(os.getpid()))
 
-    def move_files(self, source, dest, files):
+    def same_device(self, source, dest):
+        """Return True if source and dest are on the same filesystem, so
+        that moving between them is just renaming."""
+        try:
+            return os.stat(source).st_dev == os.stat(dest).st_dev
+        except OSError:
+            return True
+
+    def move_files(self, source, dest, files, journal=None, dest_tree=None):
         """
+        If dest is on another device and self.copy_threads is more than 1,
+        the files are copied in parallel - see move_in_parallel().
+
         :param source: The source directory to transfer from.
         :param dest: The destination ditory to transfer to
         :param files: Files to transfer
-        :param copied_files: A list of files already transferred
+        :param journal: A TransferJournal to record progress in, if any
+        :param dest_tree: A ScannedTree of dest, if any, to name each file's
+            target as dest already names any of the directories above it
         :return: A list of files copied.
         """
         copied_files = []
@@ -794,6 +3405,7 @@ class Sanitisation:
             self.started_transfer.set()
         swisspy.print_and_log("Moving files cleared for copy",
                               self.log_files, quiet=self.quiet)
+        moves = []
         for f in files:
             if source in f:
                 # The join in the below line adds a trailing slash.
@@ -801,34 +3413,161 @@ class Sanitisation:
             else:
                 file_path = f
             full_file_path = os.path.join(source, file_path)
-            target = os.path.join(dest,file_path)
+            if dest_tree is not None:
+                target = os.path.join(dest, dest_tree.match(file_path))
+            else:
+                target = os.path.join(dest,file_path)
             if os.path.exists(full_file_path): # Guards against resource fork disappearance
-                # 1-indexed
-                for attempt in [i+1 for i in range(self.no_of_retries)]:
-                    try:
-                        shutil.move(f, target)
-                        copied_files.append(file_path)
-                        break
-                    except Exception as e:
-                        swisspy.print_and_log("\n\tRETRY %s: %s"
-                                              "" % (attempt, f),
-                                              self.log_files,
-                                              ts=None,
-                                              quiet=self.quiet)
-                        if attempt == self.no_of_retries:
-                            msg = "\n\tFAILURE: The following file failed to " \
-                                  "transfer after %i attempts: %s\n\t" \
-                                  "The error was %s" % (self.no_of_retries,
-                                                        f, str(e))
-                            swisspy.print_and_log(msg, self.log_files,
-                                                  ts=None, quiet=self.quiet)
-                            raise
+                moves.append((f, file_path, target))
+        if journal is not None:
+            for move in moves:
+                journal.write('item', *move)
+        if self.copy_threads > 1 and moves and \
+           not self.same_device(source, dest):
+            copied_files = self.move_in_parallel(moves, journal)
+            moves = []
+        for f, file_path, target in moves:
+            # 1-indexed
+            for attempt in [i+1 for i in range(self.no_of_retries)]:
+                try:
+                    self.copy_engine.move(f, target)
+                    copied_files.append(file_path)
+                    if journal is not None:
+                        journal.write('done', f)
+                    break
+                except Exception as e:
+                    self.log_retry(attempt, f)
+                    if attempt == self.no_of_retries:
+                        self.log_failure(f, e)
+                        raise
         swisspy.print_and_log('\n\n', log_files=self.log_files, ts=None)
         log_list("Files transferred: ", copied_files,
                  log_files=self.log_files)
+        self.log_copy_report()
 
         return copied_files
 
+    def log_copy_report(self):
+        """Log how much data the copy engine has cloned and copied since
+        this was last called, if any."""
+        report = self.copy_engine.report()
+        if report:
+            swisspy.print_and_log(report, self.log_files, quiet=self.quiet)
+        self.copy_engine.reset_counts()
+
+    def log_retry(self, attempt, path):
+        """Log that attempt (1-indexed) at moving path failed"""
+        swisspy.print_and_log("\n\tRETRY %s: %s" % (attempt, path),
+                              self.log_files, ts=None, quiet=self.quiet)
+
+    def log_failure(self, path, e):
+        """Log that path couldn't be moved, in the end because of e"""
+        msg = "\n\tFAILURE: The following file failed to " \
+              "transfer after %i attempts: %s\n\t" \
+              "The error was %s" % (self.no_of_retries, path, str(e))
+        swisspy.print_and_log(msg, self.log_files, ts=None, quiet=self.quiet)
+
+    def move_in_parallel(self, moves, journal=None, resume=False):
+        """Move files to another device, self.copy_threads at a time, so
+        that small files don't each wait for the last to finish.
+
+        Directories are recreated in the destination - each exactly once,
+        before any files are copied into them - and their files copied
+        individually, then the emptied source directories removed. Each
+        file is tried self.no_of_retries times, as move_files() does; once
+        one has failed that many times no more are started, and its error
+        is raised. All logging happens in this (the calling) thread.
+
+        moves : list
+            (path to move, path to log it as, target) for each file or
+            directory
+        journal : TransferJournal
+            If given, each file is recorded in it once it has been moved.
+        resume : bool
+            If True, directories may already exist in the destination, from
+            an interrupted attempt at the same moves.
+        Returns the list of paths logged as moved.
+
+        """
+        tasks = [] # (move number, source, target)
+        made_dirs = [] # (move number, source dir, target dir, source stat)
+        for i, (f, file_path, target) in enumerate(moves):
+            if not os.path.isdir(f) or os.path.islink(f):
+                tasks.append((i, f, target))
+                continue
+            for root, dirs, files in os.walk(f):
+                rel_root = root[len(f):].lstrip('/')
+                target_dir = os.path.join(target, rel_root)
+                try:
+                    os.mkdir(target_dir)
+                except OSError as e:
+                    if not (resume and e.errno == errno.EEXIST and
+                            os.path.isdir(target_dir)):
+                        self.log_failure(root, e)
+                        raise
+                made_dirs.append((i, root, target_dir.rstrip('/'),
+                                  os.stat(root)))
+                links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+                for name in files + links:
+                    tasks.append((i, os.path.join(root, name),
+                                  os.path.join(target_dir, name)))
+
+        abort = threading.Event()
+        def move(task):
+            i, src, target = task
+            errors = []
+            if abort.is_set():
+                return i, src, None # Not started
+            for attempt in range(self.no_of_retries):
+                try:
+                    self.copy_engine.move(src, target)
+                    break
+                except Exception as e:
+                    errors.append(e)
+            if len(errors) == self.no_of_retries:
+                abort.set()
+            elif journal is not None:
+                journal.write('done', src)
+            return i, src, errors
+
+        pool = multiprocessing.pool.ThreadPool(min(self.copy_threads,
+                                                   max(1, len(tasks))))
+        try:
+            results = pool.map(move, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        incomplete = set()
+        failure = None
+        for i, src, errors in results:
+            if errors is None:
+                incomplete.add(i)
+                continue
+            for attempt, e in enumerate(errors):
+                self.log_retry(attempt + 1, src)
+            if len(errors) == self.no_of_retries:
+                incomplete.add(i)
+                if failure is None:
+                    failure = (src, errors[-1])
+
+        # Directories take their permissions and times from the source, as
+        # it was before it was emptied, once they're filled. Then the
+        # emptied source directories go, deepest first.
+        for i, root, target_dir, st in reversed(made_dirs):
+            if i in incomplete:
+                continue
+            os.chmod(target_dir, st.st_mode & 07777)
+            os.utime(target_dir, (st.st_atime, st.st_mtime))
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass # Something new has appeared in it; leave it be
+        if failure is not None:
+            self.log_failure(*failure)
+            raise failure[1]
+        return [m[1] for i, m in enumerate(moves) if i not in incomplete]
+
     def set_logs(self, folder):
         """
         Set up variables and paths for files to log to
@@ -841,29 +3580,211 @@ class Sanitisation:
         log_path =  os.path.join(log_folder,
                                  swisspy.time_stamp('short') + ".log")
         self.log_files = [log_path] # Files to log to
+        self.log_folder = log_folder
 
 def main(s):
     """ Call the requisite functions of s, a Sanitisation object"""
 
+    # Check the configuration before starting on any projects, so that a
+    # bad one doesn't stop the processing part way through the queue.
+    if s.rename and not s.rename_log_dir:
+        swisspy.print_and_log("Please specify a directory to log "
+                              "renamed files to (usually on dest.)\n",
+                              [s.temp_log_file], ts="long", quiet=s.quiet)
+        sys.exit(1)
+
     #Write a pid file
     if s.create_pid:
         s.write_pid()
 
+    resume_transfers(s)
+
+    if s.daemon:
+        run_daemon(s)
+        return
+    if s.drain:
+        drain_queue(s)
+        return
+
     try:
-        folder = swisspy.immediate_subdirs(s.to_archive_dir)[0]
+        folder = s.scheduler.order(s.to_archive_dir,
+                     swisspy.immediate_subdirs(s.to_archive_dir))[0]
     except IndexError: #'To Archive dir is empty"
         return
+    process_project(s, folder)
 
+def resume_transfers(s):
+    """Finish the transfers of any projects left in .Hidden (or in worker
+    staging slots) by a run which was killed part way through moving them -
+    see TransferJournal. Projects whose transfer fails again are left for
+    purge_hidden_dir(), as usual.
+
+    """
+    for hidden_dir in [s.hidden_dir] + s.staging_slot_dirs():
+        for name in sorted(os.listdir(hidden_dir)):
+            if not name.startswith(TRANSFER_JOURNAL_PREFIX):
+                continue
+            journal = TransferJournal(os.path.join(hidden_dir, name))
+            entries = journal.read()
+            if not journal.in_progress() or \
+               not os.path.exists(entries[0][1]): # Purged, or never staged
+                os.remove(journal.path)
+                continue
+            s.set_logs(name[len(TRANSFER_JOURNAL_PREFIX):])
+            try:
+                s.resume_transfer(journal)
+            except Exception as e:
+                log_error(s, e)
+        if hidden_dir != s.hidden_dir:
+            s.purge_hidden_dir(hidden_dir) # No worker will empty it now
+
+def run_daemon(s):
+    """Stay resident, processing projects as soon as they have finished
+    arriving in To Archive, instead of being run from cron.
+
+    To Archive is watched with inotify (see InotifyWatcher) and checked
+    whenever it changes, or at least every s.poll_interval seconds, since
+    writes deep within a project don't register on To Archive itself. A
+    project due to settle sooner is checked again as soon as it's due.
+    Projects which have settled (see QuiescenceMonitor) are handed to
+    drain_queue().
+    With an archive index, it is also reconciled with the archive every
+    s.reconcile_interval seconds.
+    s - its configuration and caches - is reused throughout. Runs until
+    killed; SIGTERM exits cleanly, so the usual clean up still happens.
+
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if s.archive_index is not None:
+        s.archive_index.start_reconcile(
+            s.reconcile_interval, s.stat_threads,
+            [os.path.join(s.logstash_dir, "errors.txt")], s.quiet)
+    watcher = InotifyWatcher(s.to_archive_dir)
+    if not watcher.available:
+        swisspy.print_and_log("inotify is unavailable; checking {0} every {1}"
+                              " seconds.\n".format(s.to_archive_dir,
+                                                   s.poll_interval),
+                              [s.temp_log_file], ts="long", quiet=s.quiet)
+    try:
+        while True:
+            ready = []
+            for folder in swisspy.immediate_subdirs(s.to_archive_dir):
+                path = os.path.join(s.to_archive_dir, folder)
+                if s.quiescence.is_ready(path):
+                    ready.append(folder)
+            if ready:
+                drain_queue(s, ready)
+            timeout = s.poll_interval
+            next_ready_in = s.quiescence.next_ready_in()
+            if next_ready_in is not None:
+                timeout = min(timeout, next_ready_in)
+            watcher.wait(timeout)
+    finally:
+        watcher.close()
+
+def log_error(s, e):
+    """Log an exception which has stopped a project being processed"""
+    try:
+        error_file = os.path.join(s.logstash_dir, "errors.txt")
+        swisspy.print_and_log("\nError encountered: " +  str(e),
+                              log_files=[error_file], quiet=False)
+    except IOError:
+        print "Couldn't open " + error_file
+
+def drain_queue(s, folders=None):
+    """Process every project waiting in To Archive, rather than just the
+    first. If s.workers is more than 1, that many worker processes take
+    projects from the queue in turn, each staging its project in a slot of
+    its own (see Sanitisation.use_staging_slot) and logging to that
+    project's log as usual. Projects whose names sanitise to the same
+    archive folder are queued together, to be processed one after another
+    by the same worker. An error in one project is logged and doesn't stop
+    the others.
+
+    s : Sanitisation
+    folders : list : str
+        Default: everything in To Archive
+        The projects to process, in any order; s.scheduler orders them.
+
+    """
+    if folders is None:
+        folders = swisspy.immediate_subdirs(s.to_archive_dir)
+    folders = s.scheduler.order(s.to_archive_dir, folders)
+    groups = OrderedDict()
+    for folder in folders:
+        name = s.sanitise_cache.sanitise(folder)['out_string']
+        groups.setdefault(name if s.case_sens else name.lower(),
+                          []).append(folder)
+    if s.workers <= 1 or len(groups) <= 1:
+        for folder in folders:
+            try:
+                process_project(s, folder)
+            except Exception as e:
+                log_error(s, e)
+                s.purge_hidden_dir()
+        return
+
+    queue = multiprocessing.Queue()
+    for group in groups.values():
+        queue.put(group)
+    workers = []
+    for slot in range(1, min(s.workers, len(groups)) + 1):
+        queue.put(None) # One 'stop' for each worker
+        worker = multiprocessing.Process(target=_queue_worker,
+                                         args=(s, slot, queue))
+        worker.start()
+        workers.append(worker)
+    # Each worker has its own copy of what the monitor knew of the projects;
+    # this one's would otherwise keep growing in daemon mode.
+    for folder in folders:
+        s.quiescence.forget(os.path.join(s.to_archive_dir, folder))
+    for worker in workers:
+        worker.join()
+    try:
+        os.rmdir(s.staging_dir)
+    except OSError:
+        pass # Not empty; purge_hidden_dir() will see to it
+
+def _queue_worker(s, slot, queue):
+    """Run in a worker process by drain_queue(): process groups of projects
+    from queue, staged in the given slot, until told to stop."""
+    s.use_staging_slot(slot)
+    try:
+        while True:
+            group = queue.get()
+            if group is None:
+                break
+            for folder in group:
+                try:
+                    process_project(s, folder)
+                except Exception as e:
+                    log_error(s, e)
+                    s.purge_hidden_dir()
+    finally:
+        s.purge_hidden_dir()
+        try:
+            os.rmdir(s.hidden_dir)
+        except OSError:
+            pass
+
+def process_project(s, folder):
+    """Sanitise a single project from To Archive and move it to s.pass_dir
+
+    s : Sanitisation
+    folder : str
+        Name of the project folder within To Archive
+
+    """
     deleted_files = [] # No files (E.g .DS_Stores) have been deleted yet.
     if s.rename:
-        if not s.rename_log_dir:
-            swisspy.print_and_log("Please specify a directory to log "
-                                  "renamed files to (usually on dest.)",
-                                  s.log_files, quiet=s.quiet)
-            sys.exit(1)
+        if not s.rename_log_dir: # main() checks this before starting
+            raise ValueError("No directory to log renamed files to")
         rename_log_file = os.path.join(s.rename_log_dir, folder + ".txt")
-        if not os.path.exists(s.rename_log_dir):
+        try:
             os.mkdir(s.rename_log_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST: # Other workers may have made it
+                raise
     else:
         # Don't log renamins
         rename_log_file = ""
@@ -872,17 +3793,24 @@ def main(s):
     folder_start_path = os.path.join(s.to_archive_dir, folder)
 
     #Check the directory to be copied isn't still being written to:
-    if swisspy.dir_being_written_to(folder_start_path):
+    if not s.quiescence.is_ready(folder_start_path):
             swisspy.print_and_log(folder + " is being written to. "
                                            "Skipping this time.",
                               [s.temp_log_file], ts="long", quiet=s.quiet)
             return
+    waited = s.quiescence.waited(folder_start_path)
+    s.quiescence.forget(folder_start_path)
 
     # Create log folder for this project
     s.set_logs(folder)
+    s.sanitise_cache.reset_counts() # Count this project's lookups alone
 
     swisspy.print_and_log("Processing " + folder + "\n",
                           s.log_files, quiet=s.quiet)
+    if waited:
+        swisspy.print_and_log("{0} waited {1:.0f} seconds for its upload to "
+                              "finish.\n".format(folder, waited),
+                              s.log_files, quiet=s.quiet)
 
     # Move everything to the hidden folder, unless it's already there,
     # in which case move it to Problem Files
@@ -898,30 +3826,51 @@ def main(s):
 
     #Sanitise directory itself, and update 'folder' if a change is made
     s.rename_to_clean(folder, s.the_root, 'dir', rename_log_file)
-    if sanitise(folder)['out_string'] != folder:
-        folder = sanitise(folder)['out_string']
+    folder = s.sanitise_cache.sanitise(folder)['out_string']
     target_path = os.path.join(s.the_root, folder)
 
-    # Walk the directory tree and sanitise the rest of the data
+    # Work out how to sanitise the rest of the data - or pick up the plan from
+    # an earlier dry run - then carry it out (or just report it).
     #TODO: Change 'errors_found' to 'illegal_characters_found'
     s.errors_found = False
-    for path, dirs, files in os.walk(target_path, topdown=False):
-        #Sanitise file names
-        for f in files:
-            s.rename_to_clean(f, path, 'file', rename_log_file)
-            for pattern in s.file_patterns_to_delete:
-                if re.match(pattern, f):
-                    full_path = os.path.join(path,f)
-                    try:
-                        os.remove(full_path)
-                        deleted_files.append(f)
-                    except Exception as e:
-                        msg = "Unable to remove file {0} \n " \
-                              "Error details: {1}\n".format(f, str(e))
-                        swisspy.print_and_log(msg, s.log_files, quiet=s.quiet)
-        #Sanitise directory names
-        for d in dirs:
-            s.rename_to_clean(d, path, 'dir', rename_log_file)
+    s.reset_project_indexes()
+    # The project is scanned once, here; the scan is kept up to date and
+    # reused for sanitising, conflict detection and logging.
+    tree = ScannedTree(target_path)
+    plan = None
+    if s.rename:
+        plan = s.load_rename_plan(target_path, tree)
+    if plan is not None:
+        swisspy.print_and_log("Applying the rename plan saved by a previous "
+                              "run ({0} renames, {1} already made).\n"
+                              "".format(len(plan), len(plan.applied)),
+                              s.log_files, quiet=s.quiet)
+        s.errors_found = len(plan) > 0
+    else:
+        plan = s.plan_renames(tree, deleted_files)
+        if os.path.exists(s.rename_plan_file('.journal')):
+            os.remove(s.rename_plan_file('.journal')) # Of an older plan
+        if s.rename and len(plan):
+            plan.save(s.rename_plan_file()) # To resume from if interrupted
+    if s.rename:
+        journal = TransferJournal(s.rename_plan_file('.journal'))
+        try:
+            s.apply_rename_plan(plan, rename_log_file, tree, journal)
+        finally:
+            journal.close()
+        for extension in ['.txt', '.journal']:
+            if os.path.exists(s.rename_plan_file(extension)):
+                os.remove(s.rename_plan_file(extension))
+    else:
+        s.apply_rename_plan(plan, rename_log_file, tree)
+        if len(plan):
+            plan.save(s.rename_plan_file())
+    s.reset_project_indexes()
+
+    cache = s.sanitise_cache
+    swisspy.print_and_log("Sanitise cache: {0} hits, {1} misses.\n"
+                          "".format(cache.hits, cache.misses),
+                          s.log_files, quiet=s.quiet)
 
     # No errors, or told to rename anyway? Great! Get moving.
     if not s.errors_found or s.rename:
@@ -930,7 +3879,7 @@ def main(s):
         msg = "Finished sanitising {0}. Moving to {1}\n".format(folder,
                                                                 s.pass_dir)
         swisspy.print_and_log(msg, s.log_files, quiet=s.quiet)
-        s.move_and_merge(target_path, passFolder)
+        s.move_and_merge(target_path, passFolder, source_tree=tree)
 
     # If we've found some abberrant characters, and the rename flag isn't set,
     # then move the project to 'Problem Files'
@@ -959,14 +3908,28 @@ if __name__ == '__main__':
                      temp_log_file=args.temp_log_file,
                      rename=args.dorename,
                      trust_source=args.trust_source,
+                     sanitise_cache_size=args.sanitise_cache_size,
+                     drain=args.drain,
+                     workers=args.workers,
+                     daemon=args.daemon,
+                     poll_interval=args.poll_interval,
+                     settle_window=args.settle_window,
+                     schedule=args.schedule,
+                     fair_weight=args.fair_weight,
+                     stat_threads=args.stat_threads,
+                     archive_index=args.archive_index,
+                     reconcile_interval=args.reconcile_interval,
+                     hash_algorithm=args.hash_algorithm,
+                     hash_threads=args.hash_threads,
+                     hash_cache_file=args.hash_cache_file,
+                     max_conflicts=args.max_conflicts,
+                     copy_threads=args.copy_threads,
+                     copy_method=args.copy_method,
+                     block_size=args.block_size,
+                     verify=args.verify,
                      )
     try:
         main(s)
     except Exception as e:
-        try:
-            error_file = os.path.join(s.logstash_dir, "errors.txt")
-            swisspy.print_and_log("\nError encountered: " +  str(e),
-                                  log_files=[error_file], quiet=False)
-        except IOError:
-            print "Couldn't open " + error_file
+        log_error(s, e)
         raise
@@ -48,7 +48,8 @@ class SanitiseTest(unittest.TestCase):
                                '-t', os.path.abspath(self.source),
                                '-p', self.dest,
                                '-r', self.log_renamed,
-                               '-l', self.log_syslog,]
+                               '-l', self.log_syslog,
+                               '--settle-window', '0',]
         self.rename_command = self.minimal_command[:]
         self.rename_command.append('-d')
 
@@ -156,6 +157,7 @@ class SanitiseTest(unittest.TestCase):
                             temp_log_file=self.temp_log,
                             test_suite=True,
                             create_pid=False,
+                            settle_window=0,
                             )
 
     def in_problem_files(self, folder):
@@ -21,6 +21,55 @@ class PickUpProjectsTest(SanitiseTest):
 
         self.assertTrue(os.path.exists(project_2))
 
+    def test_drain_picks_up_every_project(self):
+        projects = ["p1", "p2", "p3"]
+        for p in projects:
+            os.mkdir(os.path.join(self.to_archive, p))
+            swisspy.make_file(os.path.join(self.to_archive, p), 'file.txt')
+
+        s = self.minimal_object()
+        s.drain = True
+        s.workers = 2
+        s.scheduler.policy = 'shortest' # So the monitor checks each project
+        main(s)
+
+        for p in projects:
+            self.assertTrue(self.in_dest(os.path.join(p, 'file.txt')))
+        self.assertEqual(os.listdir(self.to_archive), [])
+        self.assertEqual(os.listdir(self.hidden), [])
+        self.assertEqual(s.quiescence._projects, {})
+
+    def test_projects_sanitised_alike_are_merged_in_turn(self):
+        projects = {'a:b': 'one.txt', 'a>b': 'two.txt', 'p3': 'file.txt'}
+        for p, f in projects.items():
+            os.mkdir(os.path.join(self.to_archive, p))
+            swisspy.make_file(os.path.join(self.to_archive, p), f)
+
+        s = self.minimal_object()
+        s.drain = True
+        s.workers = 3
+        main(s)
+
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dest, 'a-b'))),
+                         ['one.txt', 'two.txt'])
+        self.assertEqual(os.listdir(self.to_archive), [])
+
+    def test_staging_slots_purged_apart_from_projects(self):
+        # A project whose name looks like a staging folder is just a project
+        project = os.path.join(self.hidden, '.worker-1')
+        os.mkdir(project)
+        swisspy.make_file(project, 'file.txt')
+        s = self.minimal_object()
+        s.use_staging_slot(1)
+        os.mkdir(os.path.join(s.hidden_dir, 'p1'))
+
+        s = self.minimal_object()
+        s.purge_hidden_dir()
+
+        self.assertTrue(exists_in(self.problem_files,
+                                  os.path.join('.worker-1', 'file.txt')))
+        self.assertTrue(self.in_problem_files('p1'))
+
     def test_exits_gracefully_if_no_files_to_move(self):
         s=self.minimal_object()
         main(s)
@@ -73,5 +122,22 @@ class RemoveUnwantedFilesTest(SanitiseTest):
         self.check_in_logs('movemetoo', expected)
 
 
+class CaseSensitivityTest(SanitiseTest):
+
+    def test_names_differing_only_in_case_are_renamed(self):
+        source_dir = os.path.join(self.to_archive, 'cases')
+        os.mkdir(source_dir)
+        for name in ['shot.txt', 'SHOT.txt']:
+            swisspy.make_file(source_dir, name)
+
+        s = self.minimal_object()
+        s.case_sens = True
+        main(s)
+
+        moved = os.listdir(os.path.join(self.dest, 'cases'))
+        self.assertEqual(len(moved), 2)
+        self.assertEqual(len(set([m.lower() for m in moved])), 2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,3 +1,4 @@
+import hashlib
 import os
 import sys
 import time
@@ -156,6 +157,76 @@ class FileTransferTest(SanitiseTest):
         for f in [os.path.join(self.dest, 'bad', c) for c in clean_subdir_names]:
             self.assertTrue(os.path.exists(f), f + " does not exist")
 
+    # A dry run's rename plan is used by a later renaming run
+    def test_saved_rename_plan_applied(self):
+        bad_dir = os.path.join(self.to_archive, 'planned')
+        os.mkdir(bad_dir)
+        os.mkdir(os.path.join(bad_dir, 'sub*dir'))
+        swisspy.make_file(os.path.join(bad_dir, 'sub*dir'), 'file?')
+
+        s = self.minimal_object()
+        s.rename = False
+        main(s)
+        self.assertTrue(self.in_problem_files('planned'))
+        plan_file = os.path.join(self.logs, '.rename_plans', 'planned.txt')
+        self.assertTrue(os.path.exists(plan_file))
+
+        shutil.move(os.path.join(self.problem_files, 'planned'),
+                    self.to_archive)
+        s = self.minimal_object()
+        main(s)
+
+        self.assertTrue(os.path.exists(os.path.join(self.dest, 'planned',
+                                                    'sub_dir', 'file_')))
+        self.assertFalse(os.path.exists(plan_file))
+        self.check_in_logs('planned', ["Applying the rename plan saved"])
+
+    # An interrupted renaming run carries on where it left off
+    def test_interrupted_renames_resumed(self):
+        bad_dir = os.path.join(self.to_archive, 'planned')
+        os.mkdir(bad_dir)
+        os.mkdir(os.path.join(bad_dir, 'sub*dir'))
+        swisspy.make_file(os.path.join(bad_dir, 'sub*dir'), 'file?')
+
+        s = self.minimal_object()
+        rename_file = s.rename_file
+        def interrupt_second_rename(path_dict, prev_path, *args, **kwargs):
+            if not prev_path.endswith('file?'):
+                raise KeyboardInterrupt
+            return rename_file(path_dict, prev_path, *args, **kwargs)
+        s.rename_file = interrupt_second_rename
+        self.assertRaises(KeyboardInterrupt, main, s)
+        journal = os.path.join(self.logs, '.rename_plans', 'planned.journal')
+        self.assertTrue(os.path.exists(journal))
+
+        shutil.move(os.path.join(self.hidden, 'planned'), self.to_archive)
+        main(self.minimal_object())
+
+        self.assertTrue(os.path.exists(os.path.join(self.dest, 'planned',
+                                                    'sub_dir', 'file_')))
+        self.assertFalse(os.path.exists(journal))
+        self.check_in_logs('planned', ["(2 renames, 1 already made)"])
+
+    # ...unless the project has changed since
+    def test_stale_rename_plan_replanned(self):
+        bad_dir = os.path.join(self.to_archive, 'planned')
+        os.mkdir(bad_dir)
+        swisspy.make_file(bad_dir, 'file?')
+        s = self.minimal_object()
+        s.rename = False
+        main(s)
+
+        moved_dir = os.path.join(self.problem_files, 'planned')
+        swisspy.make_file(moved_dir, 'file_')
+        swisspy.make_file(moved_dir, '.DS_Store')
+        shutil.move(moved_dir, self.to_archive)
+        main(self.minimal_object())
+
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dest,
+                                                        'planned'))),
+                         ['file_', 'file_(1)'])
+        self.check_in_logs('planned', ["no longer matches"])
+
     # Add trailing spaces to renaming
     def test_remove_trailing_spaces(self):
         spaces_dir = os.path.join(self.to_archive, 'spaces')
@@ -393,6 +464,53 @@ class TrustSourceTest(SanitiseTest):
 
 
 
+class CaseFoldingTransferTest(SanitiseTest):
+
+    def make_archived(self, rel_path, contents):
+        path = os.path.join(self.dest, 'a_dir', rel_path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def make_uploaded(self, rel_path, contents):
+        path = os.path.join(self.to_archive, 'a_dir', rel_path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def test_files_differing_only_in_case_clash(self):
+        self.make_archived('a.txt', '1234567890')
+        self.make_uploaded('A.txt', '12345')
+
+        self.assertRaises(IOError, main, self.minimal_object())
+        with open(os.path.join(self.dest, 'a_dir', 'a.txt')) as f:
+            self.assertEqual(f.read(), '1234567890')
+        self.assertFalse(self.in_dest(os.path.join('a_dir', 'A.txt')))
+        self.assertTrue(self.in_problem_files('a_dir'))
+
+    def test_folders_differing_only_in_case_are_merged(self):
+        self.make_archived(os.path.join('shots', 'old.txt'), '12345')
+        self.make_uploaded(os.path.join('Shots', 'new.txt'), '12345')
+        self.make_uploaded(os.path.join('Shots', 'Takes', 'take.txt'), '1')
+        main(self.minimal_object())
+
+        shots = os.path.join(self.dest, 'a_dir', 'shots')
+        self.assertEqual(sorted(os.listdir(shots)),
+                         ['Takes', 'new.txt', 'old.txt'])
+        self.assertFalse(self.in_dest(os.path.join('a_dir', 'Shots')))
+
+    def test_case_sensitive_archives_keep_both(self):
+        self.make_archived('a.txt', '1234567890')
+        self.make_uploaded('A.txt', '12345')
+        s = self.minimal_object()
+        s.case_sens = True
+        main(s)
+
+        self.assertTrue(self.in_dest(os.path.join('a_dir', 'a.txt')))
+        self.assertTrue(self.in_dest(os.path.join('a_dir', 'A.txt')))
+
 class RetryTest(SanitiseTest):
 
     def test_failed_files_are_retried(self):
@@ -458,5 +576,257 @@ class RetryTest(SanitiseTest):
         self.check_in_logs('sendme', wanted)
 
 
+class ParallelMoveTest(SanitiseTest):
+
+    def cross_device_object(self):
+        s = self.minimal_object()
+        s.same_device = lambda source, dest: False
+        s.set_logs('sendme')
+        return s
+
+    def test_directories_and_files_moved_in_parallel(self):
+        source = os.path.join(self.to_archive, 'sendme')
+        os.makedirs(os.path.join(source, 'new', 'deeper'))
+        for name in ['one', os.path.join('new', 'two'),
+                     os.path.join('new', 'deeper', 'three')]:
+            with open(os.path.join(source, name), 'w') as f:
+                f.write(name)
+        os.symlink('deeper', os.path.join(source, 'new', 'link'))
+        os.utime(os.path.join(source, 'new'), (1, 1))
+        dest = os.path.join(self.dest, 'sendme')
+        os.mkdir(dest)
+
+        s = self.cross_device_object()
+        moved = s.move_files(source, dest, [os.path.join(source, 'one'),
+                                            os.path.join(source, 'new')])
+
+        self.assertEqual(moved, ['one', 'new'])
+        self.assertEqual(os.listdir(source), [])
+        with open(os.path.join(dest, 'new', 'deeper', 'three')) as f:
+            self.assertEqual(f.read(), os.path.join('new', 'deeper', 'three'))
+        self.assertEqual(os.readlink(os.path.join(dest, 'new', 'link')),
+                         'deeper')
+        self.assertEqual(os.path.getmtime(os.path.join(dest, 'new')), 1)
+
+    def test_failures_are_retried_and_raised(self):
+        source = os.path.join(self.to_archive, 'sendme')
+        os.mkdir(source)
+        swisspy.make_file(source, 'sendy.txt')
+
+        s = self.cross_device_object()
+        self.assertRaises(IOError, s.move_files, source,
+                          os.path.join(self.dest, 'missing'),
+                          [os.path.join(source, 'sendy.txt')])
+        messages = ["RETRY %s: %s" % (i, os.path.join(source, 'sendy.txt'))
+                    for i in range(1, 4)] + ["FAILURE"]
+        self.check_in_logs('sendme', messages)
+
+class HashComparisonTest(SanitiseTest):
+
+    def make_clash(self, archived, uploaded):
+        dir_source = os.path.join(self.to_archive, 'a_dir')
+        dir_dest = os.path.join(self.dest, 'a_dir')
+        for directory, contents in [(dir_source, uploaded),
+                                    (dir_dest, archived)]:
+            os.mkdir(directory)
+            with open(os.path.join(directory, 'a_file'), 'w') as f:
+                f.write(contents)
+        os.utime(os.path.join(dir_dest, 'a_file'), (1, 1))
+
+    def test_identical_files_with_different_times_are_not_transferred(self):
+        self.make_clash('12345', '12345')
+        s = self.minimal_object()
+        s.trust_source = False
+        main(s)
+
+        self.check_in_logs('a_dir', ["1 files already have up-to-date copies"])
+        self.assertFalse(self.in_problem_files('a_dir'))
+
+    def test_different_files_of_the_same_size_fail(self):
+        self.make_clash('12345', '54321')
+        s = self.minimal_object()
+        s.trust_source = False
+
+        self.assertRaises(IOError, main, s)
+        self.check_in_logs('a_dir', ["md5: " + hashlib.md5('54321').hexdigest()])
+
+    def test_archive_hashes_are_cached(self):
+        self.make_clash('12345', '54321')
+        s = self.minimal_object()
+        s.trust_source = False
+        self.assertRaises(IOError, main, s)
+        os.mkdir(os.path.join(self.to_archive, 'a_dir'))
+        with open(os.path.join(self.to_archive, 'a_dir', 'a_file'), 'w') as f:
+            f.write('54321')
+        os.utime(os.path.join(self.to_archive, 'a_dir', 'a_file'), (2, 2))
+
+        self.assertRaises(IOError, main, s)
+        log_dir = os.path.join(self.logs, 'a_dir')
+        logs = ''
+        for log in os.listdir(log_dir):
+            with open(os.path.join(log_dir, log)) as f:
+                logs += f.read()
+        self.assertTrue("Hash cache: 0 hits, 2 misses." in logs)
+        self.assertTrue("Hash cache: 1 hits, 1 misses." in logs)
+
+class FailFastTest(SanitiseTest):
+
+    def make_conflicts(self, names):
+        dir_source = os.path.join(self.to_archive, 'a_dir')
+        dir_dest = os.path.join(self.dest, 'a_dir')
+        os.mkdir(dir_source)
+        os.mkdir(dir_dest)
+        for name in names:
+            with open(os.path.join(dir_source, name), 'w') as f:
+                f.write('12345')
+            with open(os.path.join(dir_dest, name), 'w') as f:
+                f.write('1234567890')
+
+    def test_examination_stops_at_max_conflicts(self):
+        self.make_conflicts(['one', 'two', 'three'])
+        s = self.minimal_object()
+        s.max_conflicts = 1
+
+        self.assertRaises(IOError, main, s)
+        self.check_in_logs('a_dir', ["The following 1 files already exist",
+                                     "Examination stopped after 1 conflicts"])
+        self.assertTrue(self.in_problem_files('a_dir'))
+
+    def test_every_conflict_reported_by_default(self):
+        self.make_conflicts(['one', 'two', 'three'])
+
+        self.assertRaises(IOError, main, self.minimal_object())
+        self.check_in_logs('a_dir', ["The following 3 files already exist"])
+        self.check_in_logs('a_dir', ["Examination stopped"],
+                           positive_test=False)
+
+class ArchiveIndexTransferTest(SanitiseTest):
+
+    def indexed_object(self):
+        s = self.minimal_object()
+        s.archive_index = ArchiveIndex(os.path.join(self.log, 'index.db'),
+                                       self.dest)
+        return s
+
+    def make_project(self, contents):
+        os.mkdir(os.path.join(self.to_archive, 'a_dir'))
+        with open(os.path.join(self.to_archive, 'a_dir', 'a_file'), 'w') as f:
+            f.write(contents)
+
+    def test_clashes_found_from_the_catalogue(self):
+        self.make_project('1234567890')
+        main(self.indexed_object())
+        self.make_project('12345')
+
+        s = self.indexed_object()
+        self.assertTrue(s.archive_index.tree('a_dir') is not None)
+        self.assertRaises(IOError, main, s)
+        self.assertTrue(self.in_problem_files('a_dir'))
+
+    def test_files_added_by_other_means_are_found(self):
+        self.make_project('12345')
+        main(self.indexed_object())
+        with open(os.path.join(self.dest, 'a_dir', 'other'), 'w') as f:
+            f.write('1234567890')
+        os.mkdir(os.path.join(self.to_archive, 'a_dir'))
+        with open(os.path.join(self.to_archive, 'a_dir', 'other'), 'w') as f:
+            f.write('12345')
+
+        self.assertRaises(IOError, main, self.indexed_object())
+
+    def test_clashes_not_judged_from_a_stale_catalogue(self):
+        self.make_project('12345')
+        main(self.indexed_object())
+        archived = os.path.join(self.dest, 'a_dir', 'a_file')
+        recorded = os.stat(archived).st_mtime
+        with open(archived, 'w') as f:
+            f.write('1234567890')
+        self.make_project('12345')
+        uploaded = os.path.join(self.to_archive, 'a_dir', 'a_file')
+        os.utime(uploaded, (recorded, recorded))
+
+        s = self.indexed_object()
+        self.assertTrue(s.archive_index.tree('a_dir') is not None)
+        self.assertRaises(IOError, main, s)
+        self.assertTrue(self.in_problem_files('a_dir'))
+
+    def test_merges_are_recorded(self):
+        self.make_project('12345')
+        main(self.indexed_object())
+        os.mkdir(os.path.join(self.to_archive, 'a_dir'))
+        swisspy.make_file(os.path.join(self.to_archive, 'a_dir'), 'b_file')
+        s = self.indexed_object()
+        main(s)
+
+        tree = s.archive_index.tree('a_dir')
+        self.assertEqual(sorted(tree.listing[''][1]), ['a_file', 'b_file'])
+
+class ResumeTransferTest(SanitiseTest):
+
+    def interrupt_transfer(self):
+        """Leave a_dir in .Hidden as if killed while moving it to dest,
+        having moved one of its two files. Returns the journal."""
+        source = os.path.join(self.hidden, 'a_dir')
+        dest = os.path.join(self.dest, 'a_dir')
+        os.mkdir(source)
+        os.mkdir(dest)
+        swisspy.make_file(dest, 'one')
+        swisspy.make_file(source, 'two')
+        swisspy.make_file(source, 'same')
+        journal = TransferJournal(TransferJournal.path_for(self.hidden,
+                                                           'a_dir'))
+        journal.write('transfer', source, dest)
+        journal.write('same', os.path.join(source, 'same'))
+        for name in ['one', 'two']:
+            journal.write('item', os.path.join(source, name), name,
+                          os.path.join(dest, name))
+        journal.write('done', os.path.join(source, 'one'))
+        return journal
+
+    def test_interrupted_transfer_resumed(self):
+        journal = self.interrupt_transfer()
+        main(self.minimal_object())
+
+        self.assertTrue(exists_in(self.dest, os.path.join('a_dir', 'two')))
+        self.assertFalse(exists_in(self.hidden, 'a_dir'))
+        self.assertFalse(os.path.exists(journal.path))
+        self.assertFalse(self.in_problem_files('a_dir'))
+        self.check_in_logs('a_dir', ["1 of 2 items left to move"])
+
+    def test_interrupted_transfer_not_purged(self):
+        self.interrupt_transfer()
+        s = self.minimal_object()
+        s.purge_hidden_dir()
+
+        self.assertTrue(exists_in(self.hidden, os.path.join('a_dir', 'two')))
+        self.assertFalse(self.in_problem_files('a_dir'))
+
+    def test_cross_device_project_move_is_journaled(self):
+        source = os.path.join(self.hidden, 'a_dir')
+        os.makedirs(os.path.join(source, 'sub'))
+        swisspy.make_file(source, 'one')
+        swisspy.make_file(os.path.join(source, 'sub'), 'two')
+        s = self.minimal_object()
+        s.set_logs('a_dir')
+        real_rename = os.rename
+        def cross_device_rename(src, dst):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        os.rename = cross_device_rename
+        try:
+            journal = s.move_project(source, os.path.join(self.dest, 'a_dir'))
+        finally:
+            os.rename = real_rename
+
+        self.assertTrue(exists_in(self.dest, os.path.join('a_dir', 'sub',
+                                                          'two')))
+        self.assertFalse(os.path.exists(source))
+        entries = journal.read()
+        self.assertTrue(('done', os.path.join(source, 'sub', 'two')) in
+                        entries)
+        self.assertEqual(len([e for e in entries if e[0] == 'done']), 2)
+        s.end_journal(journal)
+        self.assertFalse(os.path.exists(journal.path))
+
+
 if __name__ == '__main__':
     unittest.main()
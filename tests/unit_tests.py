@@ -1,6 +1,9 @@
 #!/usr/bin/python
 __author__ = 'joshsmith'
 
+import hashlib
+import time
+
 from base import *
 
 class ObjectTest(unittest.TestCase):
@@ -30,12 +33,645 @@ class RenamingTest(unittest.TestCase):
 
         self.assertEqual(output, desired)
 
+    def test_trailing_spaces_stripped_whatever_the_flag(self):
+        output = sanitise("Pang   ", strip_trailing_spaces=False)
+
+        self.assertEqual(output['out_string'], "Pang")
+
+    def test_clean_names_are_returned_unchanged(self):
+        output = sanitise("render.0001.exr")
+
+        self.assertEqual(output['out_string'], "render.0001.exr")
+        self.assertEqual(output['subs_made'], set())
+        self.assertEqual(output['positions'], [])
+
+    def test_substitutions_and_positions_reported(self):
+        output = sanitise("a:b\tc ")
+
+        self.assertEqual(output['out_string'], "a-b c")
+        self.assertEqual(output['subs_made'],
+                         set([':', "Whitespace('\\t')", ' ']))
+        self.assertEqual(output['positions'], [1, 3, 5])
+
+    def test_sanitise_many_matches_sanitise(self):
+        names = ["render.0001.exr", "a:b", "Pang   ", "", "Thumbs.db"]
+        out_names, changed = sanitise_many(names)
+
+        self.assertEqual(out_names, [sanitise(n)['out_string'] for n in names])
+        self.assertEqual(changed, [False, True, True, False, False])
+
+    def test_lazy_results_work_out_details_when_looked_up(self):
+        output = sanitise("a:b\tc ", lazy=True)
+
+        self.assertEqual(output['out_string'], "a-b c")
+        self.assertFalse('positions' in output)
+        self.assertEqual(output['positions'], [1, 3, 5])
+        self.assertEqual(output, sanitise("a:b\tc "))
+
+class SanitiseCacheTest(unittest.TestCase):
+
+    def test_repeated_names_are_cache_hits(self):
+        cache = SanitiseCache(max_size=2)
+        for name in ["Thumbs.db", "a:b", "Thumbs.db"]:
+            cache.sanitise(name)
+
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertEqual(cache.sanitise("a:b")['out_string'], "a-b")
+
+    def test_counts_can_be_reset_without_clearing(self):
+        cache = SanitiseCache()
+        cache.sanitise("a:b")
+        cache.reset_counts()
+        cache.sanitise("a:b")
+
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_least_recently_used_names_are_evicted(self):
+        cache = SanitiseCache(max_size=2)
+        for name in ["one", "two", "three", "one"]:
+            cache.sanitise(name)
+
+        self.assertEqual(cache.hits, 0)
+
+    def test_cache_can_be_disabled(self):
+        cache = SanitiseCache(max_size=0)
+        cache.sanitise("a:b")
+        cache.sanitise("a:b")
+
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_cached_results_are_not_modified_by_callers(self):
+        cache = SanitiseCache()
+        cache.sanitise("a:b")['out_string'] = "changed"
+
+        self.assertEqual(cache.sanitise("a:b")['out_string'], "a-b")
+
+class PathIndexTest(unittest.TestCase):
+
+    def test_paths_are_found_by_directory_and_name(self):
+        index = PathIndex()
+        index.add("/a/b/Thumbs.db")
+
+        self.assertTrue("/a/b/Thumbs.db" in index)
+        self.assertFalse("/a/c/Thumbs.db" in index)
+        self.assertFalse("/a/b/thumbs.db" in index)
+
+    def test_case_folded_index_ignores_case(self):
+        index = PathIndex(fold_case=True)
+        index.add("/a/B/Thumbs.db")
+
+        self.assertTrue("/a/b/THUMBS.DB" in index)
+        index.clear()
+        self.assertEqual(len(index), 0)
+
+class DirectoryCacheTest(SanitiseTest):
+
+    def test_suffixes_allocated_without_reusing_names(self):
+        cache = DirectoryCache()
+        swisspy.make_file(self.log, 'Renamed File(1).txt')
+        paths = [cache.append_index('Renamed File', '.txt', self.log)
+                 for i in range(3)]
+
+        names = [os.path.basename(p) for p in paths]
+        self.assertEqual(names, ['Renamed File(2).txt', 'Renamed File(3).txt',
+                                 'Renamed File(4).txt'])
+        self.assertTrue(cache.exists(paths[0]))
+
+    def test_renames_keep_listing_up_to_date(self):
+        cache = DirectoryCache()
+        old_path = os.path.join(self.log, 'a:b')
+        new_path = os.path.join(self.log, 'a-b')
+        swisspy.make_file(self.log, 'a:b')
+        cache.rename(old_path, new_path)
+
+        self.assertFalse(cache.exists(old_path))
+        self.assertTrue(cache.exists(new_path))
+
+    def test_case_folded_cache_finds_names_differing_in_case(self):
+        cache = DirectoryCache(fold_case=True)
+        swisspy.make_file(self.log, 'File(1).txt')
+
+        self.assertTrue(cache.exists(os.path.join(self.log, 'file(1).TXT')))
+        path = cache.append_index('file', '.txt', self.log)
+        self.assertEqual(os.path.basename(path), 'file(2).txt')
+        self.assertFalse(DirectoryCache().exists(
+            os.path.join(self.log, 'file(1).TXT')))
+
+class RenamePlanTest(SanitiseTest):
+
+    def test_plans_apply_deepest_first(self):
+        plan = RenamePlan('/project')
+        plan.add('/project/a:', 'a-', 'dir')
+        plan.add('/project/a:/b:/c?', 'c_', 'file')
+        plan.add('/project/a:/b:', 'b-', 'dir')
+
+        order = [e[0] for e in plan.in_apply_order()]
+        self.assertEqual(order, ['a:/b:/c?', 'a:/b:', 'a:'])
+
+    def test_saved_plans_can_be_loaded(self):
+        plan = RenamePlan('/project')
+        plan.add('/project/white\tspace\n', 'white space', 'file')
+        plan_file = os.path.join(self.log, 'plan.txt')
+        plan.digest = 'abc'
+        plan.save(plan_file)
+
+        loaded = RenamePlan.load(plan_file, '/elsewhere')
+        self.assertEqual(loaded.entries, plan.entries)
+        self.assertEqual(loaded.root, '/elsewhere')
+        self.assertEqual(loaded.digest, 'abc')
+
+    def test_journaled_renames_are_not_planned_again(self):
+        root = os.path.join(self.log, 'project')
+        os.makedirs(os.path.join(root, 'a:'))
+        swisspy.make_file(os.path.join(root, 'a:'), 'c?')
+        plan = RenamePlan(root)
+        plan.add(os.path.join(root, 'a:', 'c?'), 'c_', 'file')
+        plan.add(os.path.join(root, 'a:'), 'a-', 'dir')
+        plan.digest = RenamePlan.tree_digest(ScannedTree(root))
+        plan_file = os.path.join(self.log, 'plan.txt')
+        plan.save(plan_file)
+        os.rename(os.path.join(root, 'a:', 'c?'),
+                  os.path.join(root, 'a:', 'c_'))
+        journal = TransferJournal(os.path.join(self.log, 'plan.journal'))
+        journal.write('renamed', os.path.join('a:', 'c?'))
+        journal.close()
+
+        loaded = RenamePlan.load(plan_file, root, journal.path)
+        self.assertEqual(loaded.applied, set([os.path.join('a:', 'c?')]))
+        self.assertTrue(loaded.is_applicable(ScannedTree(root)))
+        self.assertFalse(RenamePlan.load(plan_file, root).is_applicable(
+            ScannedTree(root)))
+
+class ScannedTreeTest(SanitiseTest):
+
+    def make_tree(self):
+        root = os.path.join(self.log, 'tree')
+        os.makedirs(os.path.join(root, 'a', 'b'))
+        with open(os.path.join(root, 'a', 'b', 'c.txt'), 'w') as f:
+            f.write('12345')
+        swisspy.make_file(root, 'd.txt')
+        return root
+
+    def test_scan_records_names_and_sizes(self):
+        root = self.make_tree()
+        tree = ScannedTree(root)
+
+        self.assertTrue(tree.exists(os.path.join('a', 'b')))
+        self.assertTrue(tree.exists(os.path.join('a', 'b', 'c.txt')))
+        self.assertFalse(tree.exists('e.txt'))
+        self.assertEqual(tree.stat(os.path.join('a', 'b', 'c.txt'))[0], 5)
+        walked = [w[0] for w in tree.walk(topdown=False)]
+        self.assertEqual(walked, [os.path.join(root, 'a', 'b'),
+                                  os.path.join(root, 'a'), root])
+
+    def test_renames_are_reflected_beneath_the_renamed_entry(self):
+        root = self.make_tree()
+        tree = ScannedTree(root)
+        tree.rename('a', 'z')
+
+        self.assertTrue(tree.exists(os.path.join('z', 'b', 'c.txt')))
+        self.assertFalse(tree.exists('a'))
+        self.assertEqual(sorted(tree.file_paths(under='/dest')),
+                         ['/dest/d.txt', '/dest/z/b/c.txt'])
+        self.assertEqual(tree.stat(os.path.join('z', 'b', 'c.txt'))[0], 5)
+        tree.rename(os.path.join('z', 'b', 'c.txt'), 'y.txt')
+        self.assertEqual(tree.stat(os.path.join('z', 'b', 'y.txt'))[0], 5)
+        self.assertEqual(tree.listing[os.path.join('z', 'b')], ([], ['y.txt']))
+
+    def test_stat_many_fills_in_unscanned_stats(self):
+        root = self.make_tree()
+        tree = ScannedTree(root, with_stats=False)
+        c_txt = os.path.join('a', 'b', 'c.txt')
+        tree.stat_many([c_txt, 'd.txt', 'missing.txt'], threads=2,
+                       batch_size=1)
+
+        self.assertEqual(tree.file_stats[c_txt][0], 5)
+        self.assertTrue('d.txt' in tree.file_stats)
+        self.assertRaises(OSError, tree.stat, 'missing.txt')
+
+    def test_links_are_followed_for_their_type_but_not_descended(self):
+        root = self.make_tree()
+        os.symlink('a', os.path.join(root, 'dir_link'))
+        os.symlink('d.txt', os.path.join(root, 'file_link'))
+        tree = ScannedTree(root)
+
+        self.assertTrue('dir_link' in tree.listing[''][0])
+        self.assertEqual(tree.links, set(['dir_link']))
+        self.assertFalse('dir_link' in tree.listing)
+        self.assertEqual(tree.stat('file_link'), tree.stat('d.txt'))
+
+    def test_paths_matched_case_insensitively_with_fold_case(self):
+        root = self.make_tree()
+        tree = ScannedTree(root, fold_case=True)
+        c_txt = os.path.join('A', 'B', 'C.TXT')
+
+        self.assertTrue(tree.exists(c_txt))
+        self.assertEqual(tree.match(c_txt), os.path.join('a', 'b', 'c.txt'))
+        self.assertEqual(tree.match(os.path.join('A', 'New', 'e.txt')),
+                         os.path.join('a', 'New', 'e.txt'))
+        self.assertEqual(tree.stat(c_txt)[0], 5)
+        self.assertFalse(ScannedTree(root).exists(c_txt))
+
+class ArchiveIndexTest(SanitiseTest):
+
+    def setUp(self):
+        SanitiseTest.setUp(self)
+        self.project = os.path.join(self.dest, 'project')
+        os.makedirs(os.path.join(self.project, 'sub'))
+        with open(os.path.join(self.project, 'sub', 'a.txt'), 'w') as f:
+            f.write('12345')
+        self.index = ArchiveIndex(os.path.join(self.log, 'index.db'),
+                                  self.dest)
+        self.index.record_tree(ScannedTree(self.project), 'project')
+
+    def test_recorded_trees_are_returned_from_the_catalogue(self):
+        tree = self.index.tree('project')
+        a_txt = os.path.join('sub', 'a.txt')
+
+        self.assertEqual(tree.listing, ScannedTree(self.project).listing)
+        self.assertEqual(tree.file_stats[a_txt][0], 5)
+        self.assertEqual(tree.root, self.project)
+        self.assertTrue(self.index.tree('elsewhere') is None)
+
+    def test_changed_directories_are_not_trusted(self):
+        swisspy.make_file(os.path.join(self.project, 'sub'), 'b.txt')
+        os.utime(os.path.join(self.project, 'sub'), (0, 0))
+
+        self.assertTrue(self.index.tree('project') is None)
+        self.index.reconcile()
+        os.utime(os.path.join(self.project, 'sub'), (1, 1))
+        self.assertTrue(self.index.tree('project') is None)
+
+    def test_reconcile_forgets_removed_folders(self):
+        shutil.rmtree(self.project)
+        self.index.reconcile()
+
+        self.assertEqual(self.index._rows_under('project'), [])
+
+    def test_forked_processes_have_a_lock_of_their_own(self):
+        with self.index.lock:
+            pid = os.fork()
+            if pid == 0:
+                # Would hang on the lock the parent holds, if inherited
+                try:
+                    self.index.record_tree(ScannedTree(self.project),
+                                           'project')
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+
+        self.assertTrue(self.index.tree('project') is not None)
+
+class DeleteMatcherTest(unittest.TestCase):
+
+    def test_default_patterns_use_prefix_checks(self):
+        matcher = DeleteMatcher(['\.DS_Store', '\._*'])
+
+        self.assertEqual(matcher.prefixes, ('.DS_Store', '.'))
+        self.assertTrue(matcher.regex is None)
+
+    def test_matches_agree_with_re_match(self):
+        patterns = ['\.DS_Store', '\._*', 'Thumbs\.db$', '~\$.*\.tmp']
+        matcher = DeleteMatcher(patterns)
+        for name in ['.DS_Store', '._file', '.hidden', 'a._file._bum',
+                     'Thumbs.db', 'Thumbs.dbx', '~$doc.tmp', 'file1.txt']:
+            expected = any([re.match(p, name) for p in patterns])
+            self.assertEqual(matcher.matches(name), expected, name)
+
+class InotifyWatcherTest(SanitiseTest):
+
+    def test_new_projects_wake_the_watcher(self):
+        watcher = InotifyWatcher(self.to_archive)
+        if not watcher.available:
+            return # Not Linux
+        self.assertFalse(watcher.wait(0))
+        os.mkdir(os.path.join(self.to_archive, 'new_project'))
+
+        self.assertTrue(watcher.wait(1))
+        watcher.close()
+
+class ContentHasherTest(SanitiseTest):
+
+    def test_hashes_match_hashlib(self):
+        paths = []
+        for i in range(3):
+            paths.append(os.path.join(self.log, 'file' + str(i)))
+            with open(paths[-1], 'wb') as f:
+                f.write(str(i) * (1000 * i + 1))
+        hasher = ContentHasher('md5', threads=3, chunk_size=256,
+                               max_in_flight=512)
+        hashes = hasher.hash_files(paths + [paths[0]])
+
+        for path in paths:
+            with open(path, 'rb') as f:
+                self.assertEqual(hashes[path], hashlib.md5(f.read()).hexdigest())
+
+    def test_unreadable_files_have_no_hash(self):
+        hasher = ContentHasher()
+
+        self.assertTrue(hasher.hash_file(os.path.join(self.log, 'nope')) is None)
+
+    def test_unknown_algorithms_are_refused(self):
+        self.assertRaises(ValueError, ContentHasher, 'not_a_hash')
+
+    def test_unavailable_algorithms_rejected_by_argparse(self):
+        self.assertEqual(hash_algorithm('sha1'), 'sha1')
+        self.assertRaises(argparse.ArgumentTypeError, hash_algorithm,
+                          'no-such-hash')
+
+class HashCacheTest(SanitiseTest):
+
+    def test_hashes_are_found_until_the_file_changes(self):
+        path = os.path.join(self.log, 'file')
+        swisspy.make_file(self.log, 'file')
+        cache = HashCache(os.path.join(self.log, 'hashes.db'))
+        hasher = ContentHasher(cache=cache)
+
+        first = hasher.hash_files([path])
+        self.assertEqual(hasher.hash_files([path]), first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        os.utime(path, (1, 1))
+        hasher.hash_files([path])
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_unused_entries_are_pruned(self):
+        cache = HashCache(os.path.join(self.log, 'hashes.db'), max_age=60)
+        cache.put((1, 1, 5, 1), 'md5', 'old')
+        cache.put((1, 2, 5, 1), 'md5', 'new')
+        cache.connection.execute("UPDATE hashes SET used = ? WHERE ino = 1",
+                                 (time.time() - 120,))
+        cache.prune()
+
+        self.assertTrue(cache.get((1, 1, 5, 1), 'md5') is None)
+        self.assertEqual(cache.get((1, 2, 5, 1), 'md5'), 'new')
+
+    def test_unusable_caches_are_ignored(self):
+        cache = HashCache(os.path.join(self.log, 'missing', 'hashes.db'))
+        path = os.path.join(self.log, 'file')
+        swisspy.make_file(self.log, 'file')
+
+        self.assertTrue(ContentHasher(cache=cache).hash_files([path])[path])
+
+class CopyEngineTest(SanitiseTest):
+
+    def make_source(self):
+        path = os.path.join(self.log, 'source')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(3 * 1024 ** 2 + 7))
+        os.utime(path, (1, 1))
+        return path
+
+    def check_copy(self, method):
+        source = self.make_source()
+        dest = os.path.join(self.log, 'dest_' + method)
+        engine = CopyEngine(method)
+        engine.copy_file(source, dest)
+
+        with open(source, 'rb') as f:
+            with open(dest, 'rb') as g:
+                self.assertEqual(f.read(), g.read())
+        self.assertEqual(os.path.getmtime(dest), 1)
+        return engine
+
+    def test_every_method_copies_contents_and_times(self):
+        for method in ('auto',) + CopyEngine.METHODS:
+            engine = self.check_copy(method)
+            self.assertEqual(sum(engine.bytes_copied.values()),
+                             3 * 1024 ** 2 + 7)
+
+    def test_short_kernel_copies_fall_back(self):
+        source = self.make_source()
+        dest = os.path.join(self.log, 'dest')
+        engine = CopyEngine('copy_file_range')
+        engine._copy_file_range = lambda src_fd, dst_fd, remaining: \
+            os.write(dst_fd, os.read(src_fd, 1024)) if \
+            os.lseek(src_fd, 0, os.SEEK_CUR) == 0 else 0
+        engine.copy_file(source, dest)
+
+        with open(source, 'rb') as f:
+            with open(dest, 'rb') as g:
+                self.assertEqual(f.read(), g.read())
+        self.assertEqual(engine.bytes_copied['copy_file_range'], 0)
+
+    def test_block_size_checked(self):
+        self.assertRaises(ValueError, CopyEngine, 'python', 0)
+        self.assertEqual(CopyEngine('python', 2 * CopyEngine.MAX_BLOCK)
+                         .block_size, CopyEngine.MAX_BLOCK)
+        self.assertEqual(block_size_mb('16'), 16)
+        for value in ['0', '-1', '1025', 'big']:
+            self.assertRaises(argparse.ArgumentTypeError, block_size_mb,
+                              value)
+
+    def test_python_copies_reuse_their_buffer(self):
+        source = self.make_source()
+        dest = os.path.join(self.log, 'dest')
+        engine = CopyEngine('python', block_size=1024 ** 2)
+        engine.copy_file(source, dest)
+        buf = engine._buffers.buf
+        engine.copy_file(source, dest)
+
+        self.assertTrue(engine._buffers.buf is buf)
+        self.assertEqual(engine.bytes_copied['python'], 2 * (3 * 1024 ** 2 + 7))
+        with open(source, 'rb') as f:
+            with open(dest, 'rb') as g:
+                self.assertEqual(f.read(), g.read())
+
+    def test_verified_copies(self):
+        source = self.make_source()
+        dest = os.path.join(self.log, 'dest')
+        engine = CopyEngine(verify='md5')
+        engine.copy_file(source, dest)
+
+        self.assertEqual(engine.files_verified, 1)
+        self.assertTrue("1 copies verified with md5" in engine.report())
+        self.assertEqual(engine.cached_read_backs, 0)
+
+    def test_read_backs_from_the_page_cache_are_reported(self):
+        source = self.make_source()
+        engine = CopyEngine(verify='md5')
+        engine._drop_cached = lambda f: errno.ENOSYS
+        engine.copy_file(source, os.path.join(self.log, 'dest'))
+
+        self.assertTrue("1 of them were read back from the page cache"
+                        in engine.report())
+
+    def test_copies_which_dont_verify_are_removed(self):
+        source = self.make_source()
+        dest = os.path.join(self.log, 'dest')
+        engine = CopyEngine(verify='md5')
+        engine._read_back = lambda path: hashlib.md5('corrupted')
+
+        self.assertRaises(IOError, engine.copy_file, source, dest)
+        self.assertFalse(os.path.exists(dest))
+        self.assertTrue(os.path.exists(source))
+        self.assertEqual(engine.files_verified, 0)
+
+    def test_unclonable_devices_are_remembered(self):
+        engine = self.check_copy('reflink')
+        if engine.bytes_copied['reflink']:
+            return # This filesystem can clone
+        self.assertEqual(len(engine._no_reflink), 1)
+        self.assertTrue("0 bytes cloned, 3145735 bytes copied" in
+                        engine.report())
+
+    def test_trees_are_copied_with_their_links(self):
+        source = os.path.join(self.log, 'tree')
+        os.makedirs(os.path.join(source, 'sub'))
+        swisspy.make_file(os.path.join(source, 'sub'), 'file')
+        os.symlink('sub', os.path.join(source, 'link'))
+        dest = os.path.join(self.log, 'moved')
+        engine = CopyEngine()
+        engine.copytree(source, dest)
+        shutil.rmtree(source)
+
+        self.assertTrue(os.path.exists(os.path.join(dest, 'sub', 'file')))
+        self.assertEqual(os.readlink(os.path.join(dest, 'link')), 'sub')
+
+class TransferJournalTest(SanitiseTest):
+
+    def test_interrupted_transfer_is_in_progress(self):
+        journal = TransferJournal(TransferJournal.path_for(self.hidden, 'p'))
+        self.assertFalse(journal.in_progress())
+        journal.write('transfer', 'source', 'dest')
+        journal.write('item', 'source/a', 'a', 'dest/a')
+        journal.write('done', 'source/a')
+        journal.close()
+        with open(journal.path, 'a') as f:
+            f.write("('done', 'sou") # Killed mid-write
+
+        journal = TransferJournal(journal.path)
+        self.assertEqual(journal.read()[-1], ('done', 'source/a'))
+        self.assertTrue(journal.in_progress())
+        journal.write('done', 'source/b')
+        self.assertEqual(journal.read()[-1], ('done', 'source/b'))
+
+class QuiescenceMonitorTest(SanitiseTest):
+
+    def test_project_ready_once_unchanged_for_settle_window(self):
+        project = self.make_test_folder('uploading', 'file.txt')
+        swisspy.make_file(project['dir'], 'file.txt')
+        monitor = QuiescenceMonitor(settle_window=10)
+        now = time.time()
+
+        self.assertFalse(monitor.is_ready(project['dir'], now))
+        with open(project['file'], 'w') as f:
+            f.write("still arriving")
+        self.assertFalse(monitor.is_ready(project['dir'], now + 5))
+        self.assertFalse(monitor.is_ready(project['dir'], now + 12))
+        self.assertTrue(monitor.is_ready(project['dir'], now + 15))
+        self.assertEqual(monitor.waited(project['dir'], now + 15), 15)
+        self.assertEqual(monitor.size_estimate(project['dir']), 14)
+
+    def test_long_settled_projects_ready_on_first_check(self):
+        project = self.make_test_folder('settled', 'file.txt')
+        swisspy.make_file(project['dir'], 'file.txt')
+        monitor = QuiescenceMonitor(settle_window=10)
+
+        self.assertTrue(monitor.is_ready(project['dir'], time.time() + 60))
+
+    def test_time_until_the_next_project_settles(self):
+        project = self.make_test_folder('uploading', 'file.txt')
+        swisspy.make_file(project['dir'], 'file.txt')
+        monitor = QuiescenceMonitor(settle_window=10)
+        now = time.time()
+
+        self.assertEqual(monitor.next_ready_in(now), None)
+        monitor.is_ready(project['dir'], now)
+        with open(project['file'], 'w') as f:
+            f.write("still arriving")
+        monitor.is_ready(project['dir'], now + 5)
+        self.assertAlmostEqual(monitor.next_ready_in(now + 7), 8)
+        monitor.is_ready(project['dir'], now + 15)
+        self.assertEqual(monitor.next_ready_in(now + 15), None)
+
+class ProjectSchedulerTest(SanitiseTest):
+
+    def make_projects(self):
+        for name, size in [('big', 5000), ('medium', 500), ('small', 50),
+                           ('tiny', 5)]:
+            project = self.make_test_folder(name, 'file')
+            with open(project['file'], 'w') as f:
+                f.write('x' * size)
+        return ['big', 'medium', 'small', 'tiny']
+
+    def test_first_seen_first(self):
+        folders = self.make_projects()
+        state_file = os.path.join(self.log, 'schedule.txt')
+        scheduler = ProjectScheduler('fifo', state_file=state_file)
+        scheduler.order(self.to_archive, ['tiny'])
+        time.sleep(0.01)
+        scheduler.order(self.to_archive, ['small', 'tiny'])
+        # Renaming within a project doesn't make it arrive again
+        os.rename(os.path.join(self.to_archive, 'tiny', 'file'),
+                  os.path.join(self.to_archive, 'tiny', 'renamed'))
+
+        scheduler = ProjectScheduler('fifo', state_file=state_file)
+        self.assertEqual(scheduler.order(self.to_archive, folders),
+                         ['tiny', 'small', 'big', 'medium'])
+
+    def test_sizes_reused_while_a_project_is_unchanged(self):
+        folders = self.make_projects()
+        state_file = os.path.join(self.log, 'schedule.txt')
+        ProjectScheduler('shortest', state_file=state_file).order(
+            self.to_archive, folders)
+        scheduler = ProjectScheduler('shortest', state_file=state_file)
+        scheduler.monitor.is_ready = None # Mustn't be called
+
+        self.assertEqual(scheduler.order(self.to_archive, folders),
+                         ['tiny', 'small', 'medium', 'big'])
+
+    def test_shortest_first(self):
+        folders = self.make_projects()
+        scheduler = ProjectScheduler('shortest')
+
+        self.assertEqual(scheduler.order(self.to_archive, folders),
+                         ['tiny', 'small', 'medium', 'big'])
+
+    def test_fair_share_starts_large_projects_among_small(self):
+        folders = self.make_projects()
+        scheduler = ProjectScheduler('fair', fair_weight=2)
+
+        self.assertEqual(scheduler.order(self.to_archive, folders),
+                         ['tiny', 'small', 'big', 'medium'])
+
+    def test_default_order_is_by_name(self):
+        folders = self.make_projects()
+
+        self.assertEqual(ProjectScheduler().order(self.to_archive, folders),
+                         ['big', 'medium', 'small', 'tiny'])
+
+class MainTest(SanitiseTest):
+
+    def test_renaming_without_a_rename_log_dir_stops_before_processing(self):
+        os.mkdir(os.path.join(self.to_archive, 'p1'))
+        s = self.minimal_object()
+        s.rename_log_dir = None
+
+        self.assertRaises(SystemExit, main, s)
+        self.assertTrue(exists_in(self.to_archive, 'p1'))
+        self.assertRaises(ValueError, process_project, s, 'p1')
+
 class RetryTest(SanitiseTest):
 
     def test_can_set_trust_source(self):
         s = self.minimal_object()
         s.trust_source = True
 
+class ProjectIndexTest(SanitiseTest):
+
+    def test_dry_run_suggestions_are_indexed_and_reset(self):
+        s = self.minimal_object()
+        s.rename = False
+        project = os.path.join(s.hidden_dir, 'project')
+        os.mkdir(project)
+        s.rename_to_clean('a:b', project, 'file', '')
+        s.rename_to_clean('a?b', project, 'file', '')
+
+        self.assertTrue(os.path.join(project, 'a-b') in s.sanitised_index)
+        self.assertTrue(os.path.join(project, 'a_b') in s.sanitised_index)
+        s.reset_project_indexes()
+        self.assertEqual(len(s.sanitised_index), 0)
+
 class LogFileTest(SanitiseTest):
 
     def test_correct_name_given_to_log_folder(self):